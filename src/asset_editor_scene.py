@@ -5,6 +5,7 @@ from PyQt5.QtCore import (
 )
 from PyQt5.QtGui import (
     QPixmap,
+    QPainter,
     QImage,
     QColor,
     QPen
@@ -35,12 +36,15 @@ class AssetEditorScene(QGraphicsScene):
         self.setSceneRect(self.itemsBoundingRect())
 
     def crop_image(self, crop_rect):
+        return self.image.copy(self.crop_pixels(crop_rect))
+
+    def crop_pixels(self, crop_rect):
         scale_factor = 8
         x = crop_rect.x() * scale_factor
         y = crop_rect.y() * scale_factor
         width = crop_rect.width() * scale_factor
         height = crop_rect.height() * scale_factor
-        return self.image.copy(QRect(x, y, width, height))
+        return QRect(x, y, width, height)
 
     def get_image(self, cropped=False):
         return self.image if not cropped else self.crop_image(self.crop_rect)
@@ -50,6 +54,21 @@ class AssetEditorScene(QGraphicsScene):
         self.image = image
         self.select_cells(self.crop_rect)
 
+    @pyqtSlot(QRect)
+    def update_pixels(self, pixel_rect):
+        crop_pixels = self.crop_pixels(self.crop_rect)
+        pixel_rect = pixel_rect.intersected(crop_pixels)
+        pixmap = self.pixmap.pixmap()
+        if pixel_rect.isEmpty() or pixmap.isNull():
+            return
+
+        # Repaint only the edited pixels of the displayed selection
+        painter = QPainter(pixmap)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(pixel_rect.topLeft() - crop_pixels.topLeft(), self.image, pixel_rect)
+        painter.end()
+        self.pixmap.setPixmap(pixmap)
+
     @pyqtSlot(QColor, int)
     def set_color(self, color, index):
         self.image.setColor(index, color.rgb())
@@ -6,7 +6,10 @@ from PyQt5.QtCore import (
 )
 from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import QUndoCommand
-from undo_stack import Validator
+from undo_stack import (
+    Validator,
+    CommandId
+)
 
 class ColorData(QObject):
 
@@ -115,6 +118,19 @@ class cmd_set_color(QUndoCommand):
     def undo(self):
         self.data_source.update_color(self.palette_name, self.original_color, self.update_index)
 
+    def id(self):
+        return CommandId.SET_COLOR
+
+    def mergeWith(self, other):
+        if (other.data_source is not self.data_source or
+            other.palette_name != self.palette_name or
+            other.update_index != self.update_index):
+            return False
+
+        self.update_color = other.update_color
+        self.setObsolete(self.update_color == self.original_color)
+        return True
+
     def validate(self):
         return Validator(True, "")
 
@@ -132,6 +148,17 @@ class cmd_rename_color_palette(QUndoCommand):
     def undo(self):
         self.data_source.rename_color_palette(self.new_palette_name, self.old_palette_name)
 
+    def id(self):
+        return CommandId.RENAME_COLOR_PALETTE
+
+    def mergeWith(self, other):
+        if other.data_source is not self.data_source or other.old_palette_name != self.new_palette_name:
+            return False
+
+        self.new_palette_name = other.new_palette_name
+        self.setObsolete(self.new_palette_name == self.old_palette_name)
+        return True
+
     def validate(self):
         if self.old_palette_name == self.new_palette_name:
             return Validator(False, "")
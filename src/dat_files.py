@@ -0,0 +1,328 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+import sys
+from array import array
+from pixel_data import PixelData
+from project_file import (
+    tile_map_word_bytes,
+    unpack_tile_map_words
+)
+
+# JCAP .DAT files generated from a project, in the order they're written
+dat_files = {
+    "sprites": "sprites.dat",
+    "tiles": "tiles.dat",
+    "sprite_color_palettes": "sprite_color_palettes.dat",
+    "tile_color_palettes": "tile_color_palettes.dat",
+    "tile_maps": "tile_maps.dat"
+}
+
+# Each asset row is a little endian word of 4 bit pixels, leftmost pixel in
+# the top nibble, so an 8x8 asset packs to 32 bytes
+asset_row_size = 4
+asset_size = asset_row_size * PixelData.asset_height
+palette_size = 16
+
+# Files are hashed in blocks, each asset or palette being its own block,
+# so an edit only rewrites the blocks it touched
+block_sizes = {
+    "sprites": asset_size,
+    "tiles": asset_size,
+    "sprite_color_palettes": palette_size,
+    "tile_color_palettes": palette_size,
+    "tile_maps": 512
+}
+
+# Sidecar kept beside the generated files describing what was last written
+manifest_file = "dat_manifest.json"
+
+# Shifts each pixel index into the high nibble of a byte, and back out
+high_nibbles = bytes((index << 4) & 0xFF for index in range(256))
+high_nibble_values = bytes(index >> 4 for index in range(256))
+low_nibble_values = bytes(index & 0xF for index in range(256))
+
+def pack_sheet(pixels, width, height, asset_count):
+    # Pairs of pixels are merged into bytes across the whole sheet at once,
+    # leaving each sheet row as big endian asset row words
+    pixels = bytes(pixels)
+    packed_pixels = (
+        int.from_bytes(pixels[0::2].translate(high_nibbles), "big") |
+        int.from_bytes(pixels[1::2], "big")
+    ).to_bytes(len(pixels) // 2, "big")
+    sheet_words = array("I")
+    sheet_words.frombytes(packed_pixels)
+
+    # Asset rows are every assets_per_row'th word from the asset's first one
+    assets_per_row = width // PixelData.asset_width
+    words_per_asset_row = assets_per_row * PixelData.asset_height
+    asset_words = array("I")
+    for asset_index in range(asset_count):
+        first_word = (
+            (asset_index // assets_per_row) * words_per_asset_row +
+            asset_index % assets_per_row
+        )
+        asset_words.extend(sheet_words[first_word:first_word + words_per_asset_row:assets_per_row])
+
+    if sys.byteorder == "little":
+        asset_words.byteswap()
+    return asset_words.tobytes()
+
+def pack_color_palettes(palettes, transparent):
+    # Color 0 of a palette with transparency is never drawn, so it's zeroed
+    return b"".join(
+        bytes(1) + bytes(palette["contents"][1:palette_size])
+        if transparent else
+        bytes(palette["contents"][:palette_size])
+        for palette in palettes
+    )
+
+def pack_tile_maps(tile_maps):
+    return b"".join(tile_map_word_bytes(words) for _, _, _, words in tile_maps)
+
+def sections_to_dat(sections):
+    sprites = sections["sprites"]
+    tiles = sections["tiles"]
+    return {
+        "sprites": pack_sheet(*sprites[:3], len(sprites[3])),
+        "tiles": pack_sheet(*tiles[:3], len(tiles[3])),
+        "sprite_color_palettes": pack_color_palettes(sections["sprite_color_palettes"], True),
+        "tile_color_palettes": pack_color_palettes(sections["tile_color_palettes"], False),
+        "tile_maps": pack_tile_maps(sections["tile_maps"])
+    }
+
+def unpack_sheet(buffer):
+    # Inverse of pack_sheet: slot each asset's rows into the sheet's words,
+    # then split every byte of the sheet into its two pixels at once
+    if len(buffer) % asset_size:
+        raise ValueError("Asset data isn't a whole number of assets")
+
+    asset_words = array("I")
+    asset_words.frombytes(buffer)
+    if sys.byteorder == "little":
+        asset_words.byteswap()
+
+    asset_count = len(asset_words) // PixelData.asset_height
+    assets_per_row = PixelData.assets_per_line
+    words_per_asset_row = assets_per_row * PixelData.asset_height
+    asset_rows = math.ceil(asset_count / assets_per_row)
+    sheet_words = array("I", [0]) * (asset_rows * words_per_asset_row)
+    for asset_index in range(asset_count):
+        first_word = (
+            (asset_index // assets_per_row) * words_per_asset_row +
+            asset_index % assets_per_row
+        )
+        sheet_words[first_word:first_word + words_per_asset_row:assets_per_row] = asset_words[
+            asset_index * PixelData.asset_height:(asset_index + 1) * PixelData.asset_height
+        ]
+
+    packed_pixels = sheet_words.tobytes()
+    pixels = bytearray(len(packed_pixels) * 2)
+    pixels[0::2] = packed_pixels.translate(high_nibble_values)
+    pixels[1::2] = packed_pixels.translate(low_nibble_values)
+
+    width = PixelData.asset_width * assets_per_row
+    height = asset_rows * PixelData.asset_height
+    return bytes(pixels), width, height, asset_count
+
+def unpack_color_palettes(buffer, names, transparent_colors, name_prefix):
+    if len(buffer) % palette_size:
+        raise ValueError("Palette data isn't a whole number of palettes")
+
+    palette_count = len(buffer) // palette_size
+    if names is not None and len(names) != palette_count:
+        raise ValueError("Palette names don't match the palette data")
+    if transparent_colors is not None and len(transparent_colors) != palette_count:
+        raise ValueError("Transparent colors don't match the palette data")
+
+    palettes = []
+    for index in range(palette_count):
+        contents = list(buffer[index * palette_size:(index + 1) * palette_size])
+        if transparent_colors is not None:
+            contents[0] = transparent_colors[index]
+        palettes.append({
+            "name": names[index] if names is not None else name_prefix + str(index),
+            "contents": contents
+        })
+
+    return palettes
+
+def unpack_tile_maps(buffer, layout):
+    if len(buffer) % 2:
+        raise ValueError("Tile map data isn't a whole number of tiles")
+
+    # Legacy files carry no dimensions, so they hold one tile map in its
+    # most square layout, which fits the screen sized maps JCAP uses
+    cell_count = len(buffer) // 2
+    if layout is None:
+        height = max(
+            (
+                divisor for divisor in range(1, int(math.sqrt(cell_count)) + 1)
+                if cell_count % divisor == 0
+            ),
+            default=0
+        )
+        layout = [["tile_map_0", cell_count // height if height else 0, height]]
+
+    tile_maps = []
+    offset = 0
+    for name, width, height in layout:
+        end = offset + width * height * 2
+        tile_maps.append((name, width, height, unpack_tile_map_words(buffer[offset:end])))
+        offset = end
+
+    return tile_maps
+
+def project_metadata(sections):
+    # What the .DAT files don't hold, kept so they import losslessly
+    return {
+        "sprites": list(sections["sprites"][3]),
+        "tiles": list(sections["tiles"][3]),
+        "sprite_color_palettes": [palette["name"] for palette in sections["sprite_color_palettes"]],
+        "sprite_transparent_colors": [
+            palette["contents"][0] for palette in sections["sprite_color_palettes"]
+        ],
+        "tile_color_palettes": [palette["name"] for palette in sections["tile_color_palettes"]],
+        "tile_maps": [[name, width, height] for name, width, height, _ in sections["tile_maps"]]
+    }
+
+def read_dat_file(path, unpack):
+    with open(path, "rb") as dat_file:
+        if os.fstat(dat_file.fileno()).st_size == 0:
+            return unpack(b"")
+        with mmap.mmap(dat_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return unpack(buffer)
+
+def read_dat_files(directory):
+    # Names and dimensions come from the manifest where it still describes
+    # the files, otherwise they're made up as for a new project
+    manifest = read_manifest(directory)
+    paths = {key: os.path.join(directory, file_name) for key, file_name in dat_files.items()}
+    metadata = manifest.get("project", {})
+    if not all(
+        is_untouched(paths[key], manifest.get(file_name)) for key, file_name in dat_files.items()
+    ):
+        metadata = {}
+
+    sections = {}
+    for key, name_prefix in (("sprites", "sprite_"), ("tiles", "tile_")):
+        pixels, width, height, asset_count = read_dat_file(paths[key], unpack_sheet)
+        names = metadata.get(key)
+        if names is None or len(names) != asset_count:
+            names = [name_prefix + str(index) for index in range(asset_count)]
+        sections[key] = (pixels, width, height, names)
+
+    for key, name_prefix, transparent_colors in (
+        (
+            "sprite_color_palettes",
+            "sprite_color_palette_",
+            metadata.get("sprite_transparent_colors")
+        ),
+        ("tile_color_palettes", "tile_color_palette_", None)
+    ):
+        sections[key] = read_dat_file(
+            paths[key],
+            lambda buffer:
+            unpack_color_palettes(buffer, metadata.get(key), transparent_colors, name_prefix)
+        )
+
+    sections["tile_maps"] = read_dat_file(
+        paths["tile_maps"],
+        lambda buffer: unpack_tile_maps(buffer, metadata.get("tile_maps"))
+    )
+
+    return sections
+
+def is_untouched(path, entry):
+    # A manifest entry only describes its file if nothing else wrote it since
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+
+    return (
+        entry is not None and
+        [stat.st_size, stat.st_mtime_ns] == [entry.get("size"), entry.get("mtime")]
+    )
+
+def content_hash(contents):
+    return hashlib.blake2b(contents, digest_size=16).hexdigest()
+
+def block_hashes(contents, block_size):
+    return [
+        content_hash(contents[offset:offset + block_size])
+        for offset in range(0, len(contents), block_size)
+    ]
+
+def changed_blocks(old_hashes, new_hashes):
+    # Runs of consecutive blocks whose hashes differ, as (first, last + 1)
+    runs = []
+    for index, (old_hash, new_hash) in enumerate(zip(old_hashes, new_hashes)):
+        if old_hash == new_hash:
+            continue
+        if runs and runs[-1][1] == index:
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1])
+
+    return runs
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, manifest_file), "r") as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(directory, manifest):
+    manifest_path = os.path.join(directory, manifest_file)
+    try:
+        with open(manifest_path + ".tmp", "w") as manifest_temp:
+            json.dump(manifest, manifest_temp)
+        os.replace(manifest_path + ".tmp", manifest_path)
+    except Exception:
+        if os.path.exists(manifest_path + ".tmp"):
+            os.remove(manifest_path + ".tmp")
+        raise
+
+def write_dat_file(path, contents, block_size, previous_entry):
+    entry = {"hash": content_hash(contents), "blocks": block_hashes(contents, block_size)}
+    untouched = is_untouched(path, previous_entry)
+    if untouched and previous_entry.get("hash") == entry["hash"]:
+        return previous_entry
+
+    if (untouched and
+        previous_entry["size"] == len(contents) and
+        len(previous_entry.get("blocks", ())) == len(entry["blocks"])):
+        with open(path, "r+b") as dat_file:
+            for first_block, end_block in changed_blocks(previous_entry["blocks"], entry["blocks"]):
+                dat_file.seek(first_block * block_size)
+                dat_file.write(contents[first_block * block_size:end_block * block_size])
+    else:
+        with open(path, "wb") as dat_file:
+            dat_file.write(contents)
+
+    stat = os.stat(path)
+    entry["size"] = stat.st_size
+    entry["mtime"] = stat.st_mtime_ns
+    return entry
+
+def write_dat_files(directory, sections):
+    # Files and blocks whose contents match the manifest are left alone,
+    # keeping the files' timestamps for downstream build caches
+    previous_manifest = read_manifest(directory)
+    manifest = {}
+    for key, contents in sections_to_dat(sections).items():
+        file_name = dat_files[key]
+        manifest[file_name] = write_dat_file(
+            os.path.join(directory, file_name),
+            contents,
+            block_sizes[key],
+            previous_manifest.get(file_name)
+        )
+    manifest["project"] = project_metadata(sections)
+
+    if manifest != previous_manifest:
+        write_manifest(directory, manifest)
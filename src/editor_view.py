@@ -1,6 +1,9 @@
 from PyQt5.QtCore import (
     Qt,
     QEvent,
+    QPoint,
+    QRect,
+    QTimer,
     pyqtSlot,
     pyqtSignal
 )
@@ -11,7 +14,9 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtGui import (
     QColor,
-    QImage
+    QImage,
+    QMouseEvent,
+    QGuiApplication
 )
 from tools.base_tool import ToolType
 from tools.pen_tool import PenTool
@@ -21,10 +26,12 @@ from tools.line_tool import LineTool
 from tools.rectangle_tool import RectangleTool
 from tools.ellipse_tool import EllipseTool
 from tools.fill_tool import FillTool
+from tools.stroke_preview import StrokePreviewItem
 
 class EditorView(QGraphicsView):
 
-    scene_edited = pyqtSignal(QImage)
+    scene_edited = pyqtSignal(QImage, QPoint)
+    color_replaced = pyqtSignal(int, int, QRect)
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -35,6 +42,12 @@ class EditorView(QGraphicsView):
         self.selection = None
         self.last_pos = None
         self.active_tool = None
+        self.stroke_preview = None
+        self.pending_moves = []
+        self.move_timer = QTimer(self)
+        self.move_timer.setSingleShot(True)
+        self.move_timer.setInterval(self.frame_interval())
+        self.move_timer.timeout.connect(self.flush_moves)
         self.tools = {
             ToolType.ARROW: ArrowTool(self),
             ToolType.SELECT: SelectTool(self),
@@ -50,6 +63,7 @@ class EditorView(QGraphicsView):
         self.tools[ToolType.RECTANGLE].scene_edited.connect(self.scene_edited)
         self.tools[ToolType.ELLIPSE].scene_edited.connect(self.scene_edited)
         self.tools[ToolType.FILL].scene_edited.connect(self.scene_edited)
+        self.tools[ToolType.FILL].color_replaced.connect(self.color_replaced)
 
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
@@ -70,7 +84,12 @@ class EditorView(QGraphicsView):
             self.verticalScrollBar().setValue(self.verticalScrollBar().value() - delta.y())
 
         if event.buttons() == Qt.LeftButton:
-            self.tools[self.active_tool].mouseMoveEvent(event)
+            # Qt deletes the event once handled, so queue a copy
+            self.pending_moves.append(
+                QMouseEvent(event.type(), event.localPos(), event.button(), event.buttons(), event.modifiers())
+            )
+            if not self.move_timer.isActive():
+                self.move_timer.start()
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.MiddleButton:
@@ -79,8 +98,24 @@ class EditorView(QGraphicsView):
         super().mouseReleaseEvent(event)
 
         if event.button() == Qt.LeftButton:
+            self.flush_moves()
             self.tools[self.active_tool].mouseReleaseEvent(event)
 
+    @staticmethod
+    def frame_interval():
+        screen = QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen else 0
+        return int(1000 / refresh_rate) if refresh_rate > 0 else 16
+
+    @pyqtSlot()
+    def flush_moves(self):
+        # Hand every move queued since the last frame to the tool in one update
+        self.move_timer.stop()
+        pending_moves = self.pending_moves
+        self.pending_moves = []
+        if pending_moves:
+            self.tools[self.active_tool].mouseMoveEvents(pending_moves)
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Escape:
             self.clear_selection()
@@ -103,6 +138,9 @@ class EditorView(QGraphicsView):
     def setScene(self, scene: QGraphicsScene) -> None:
         super().setScene(scene)
         self.scene().installEventFilter(self)
+        # The scene owns the preview item, so each new scene gets its own
+        self.stroke_preview = StrokePreviewItem()
+        self.scene().addItem(self.stroke_preview)
 
     def eventFilter(self, source, event):
         if event.type() == QEvent.GraphicsSceneWheel:
@@ -1,9 +1,12 @@
 import copy
-import json
+import struct
+import threading
 from pathlib import Path
 from PyQt5.QtCore import (
+    Qt,
     QSettings,
     QCoreApplication,
+    pyqtSignal,
     pyqtSlot,
     QRect
 )
@@ -13,6 +16,7 @@ from PyQt5.QtWidgets import (
     QMainWindow,
     QFileDialog,
     QMessageBox,
+    QAction,
     QActionGroup
 )
 from ui.main_window_ui import Ui_main_window
@@ -22,7 +26,8 @@ from pixel_data import (
     cmd_add_pixel_palette_row,
     cmd_remove_pixel_palette_row,
     cmd_set_asset_name,
-    cmd_set_pixels
+    cmd_set_pixels,
+    cmd_replace_color
 )
 from color_data import (
     ColorData,
@@ -40,17 +45,35 @@ from tile_map_data import (
 from pixel_palette import PixelPalette
 from color_palette import ColorPalette
 from asset_editor_scene import AssetEditorScene
-from map_editor_scene import (
-    MapEditorScene,
-    RenderedTile
-)
+from map_editor_scene import MapEditorScene
+from tile_atlas import TileAtlas
 from tools.base_tool import ToolType
 from undo_stack import UndoStack
+from journal import Journal
+from section_cache import SectionCache
+from dat_files import (
+    read_dat_files,
+    write_dat_files
+)
+from project_file import (
+    is_binary_project,
+    binary_extension,
+    json_to_sections,
+    read_binary_project,
+    read_json_project,
+    write_encoded_project
+)
 
 class Jide(QMainWindow, Ui_main_window):
 
+    project_saved = pyqtSignal(int)
+    project_save_failed = pyqtSignal(str)
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.edit_count = 0
+        self.save_thread = None
+        self.dat_directory = None
         self.setupUi(self)
         self.setup_window()
         self.init_models()
@@ -83,6 +106,10 @@ class Jide(QMainWindow, Ui_main_window):
         action_redo = self.undo_stack.createRedoAction(self, "&Redo")
         action_redo.setShortcut(QKeySequence.Redo)
         self.menu_edit.addActions([action_undo, action_redo])
+        self.undo_stack.cleanChanged.connect(self.update_journal)
+        self.undo_stack.indexChanged.connect(self.count_edit)
+        self.project_saved.connect(self.finish_save)
+        self.project_save_failed.connect(self.show_error_dialog)
 
         self.action_new.triggered.connect(self.new_project)
         self.action_save.triggered.connect(self.save_project)
@@ -92,7 +119,10 @@ class Jide(QMainWindow, Ui_main_window):
         self.action_close.triggered.connect(self.close_project)
         self.action_exit.triggered.connect(self.quit_application)
         self.action_preferences.triggered.connect(self.open_preferences)
-        self.action_gen_dat_files.triggered.connect(lambda temp: print("this will generate .DAT files"))
+        self.action_gen_dat_files.triggered.connect(self.generate_dat_files)
+        self.action_import_dat_files = QAction("Import .DAT Files", self)
+        self.menu_jcap.insertAction(self.action_load_jcap_system, self.action_import_dat_files)
+        self.action_import_dat_files.triggered.connect(self.import_dat_files)
         self.action_load_jcap_system.triggered.connect(lambda temp: print("this will load the JCAP system"))
 
         self.editor_tabs.currentChanged.connect(self.select_tab)
@@ -103,6 +133,21 @@ class Jide(QMainWindow, Ui_main_window):
         self.sprite_pixel_data = PixelData()
         self.tile_pixel_data = PixelData()
         self.tile_map_data = TileMapData()
+        self.tile_atlas = TileAtlas(self.tile_color_data, self.tile_pixel_data)
+        self.journal = Journal(
+            self.sprite_pixel_data,
+            self.tile_pixel_data,
+            self.sprite_color_data,
+            self.tile_color_data,
+            self.tile_map_data
+        )
+        self.section_cache = SectionCache(
+            self.sprite_pixel_data,
+            self.tile_pixel_data,
+            self.sprite_color_data,
+            self.tile_color_data,
+            self.tile_map_data
+        )
 
         self.undo_stack.error_thrown.connect(self.show_error_dialog)
 
@@ -244,22 +289,48 @@ class Jide(QMainWindow, Ui_main_window):
         )
 
         self.sprite_editor_view.scene_edited.connect(
-            lambda new_pixels:
+            lambda new_pixels, origin:
             self.undo_stack.push(
                 cmd_set_pixels(
                     self.sprite_pixel_data,
                     new_pixels,
-                    self.sprite_pixel_palette.get_selection()
+                    self.sprite_pixel_palette.get_selection(),
+                    origin
+                )
+            )
+        )
+        self.sprite_editor_view.color_replaced.connect(
+            lambda old_color_index, new_color_index, region:
+            self.undo_stack.push(
+                cmd_replace_color(
+                    self.sprite_pixel_data,
+                    old_color_index,
+                    new_color_index,
+                    self.sprite_pixel_palette.get_selection(),
+                    region
                 )
             )
         )
         self.tile_editor_view.scene_edited.connect(
-            lambda new_pixels:
+            lambda new_pixels, origin:
             self.undo_stack.push(
                 cmd_set_pixels(
                     self.tile_pixel_data,
                     new_pixels,
                     self.tile_pixel_palette.get_selection(),
+                    origin
+                )
+            )
+        )
+        self.tile_editor_view.color_replaced.connect(
+            lambda old_color_index, new_color_index, region:
+            self.undo_stack.push(
+                cmd_replace_color(
+                    self.tile_pixel_data,
+                    old_color_index,
+                    new_color_index,
+                    self.tile_pixel_palette.get_selection(),
+                    region
                 )
             )
         )
@@ -331,6 +402,13 @@ class Jide(QMainWindow, Ui_main_window):
         self.tile_map_data.tile_map_added.connect(self.tile_map_picker.add_tile_map)
         self.tile_map_data.tile_map_removed.connect(self.tile_map_picker.remove_tile_map)
         self.tile_map_data.tile_map_renamed.connect(self.tile_map_picker.rename_tile_map)
+        # Queued, as tile maps can be loaded while they're being painted
+        self.tile_map_data.tile_map_load_failed.connect(
+            lambda tile_map_name: self.show_error_dialog(
+                f"Unable to load tile map {tile_map_name} due to malformed data"
+            ),
+            Qt.QueuedConnection
+        )
 
         self.sprite_color_data.color_updated.connect(self.sprite_color_palette.update_color)
         self.tile_color_data.color_updated.connect(self.tile_color_palette.update_color)
@@ -359,11 +437,13 @@ class Jide(QMainWindow, Ui_main_window):
         self.tile_pixel_data.data_updated.connect(
             lambda: self.tile_pixel_palette.set_pixel_palette(self.tile_pixel_data.get_image())
         )
+        self.sprite_pixel_data.pixels_updated.connect(self.sprite_pixel_palette.update_pixels)
+        self.tile_pixel_data.pixels_updated.connect(self.tile_pixel_palette.update_pixels)
 
     def setup_editor(self):
         self.sprite_scene = AssetEditorScene()
         self.tile_scene = AssetEditorScene()
-        self.tile_map_scene = MapEditorScene()
+        self.tile_map_scene = MapEditorScene(self.tile_atlas)
         self.sprite_editor_view.setScene(self.sprite_scene)
         self.tile_editor_view.setScene(self.tile_scene)
         self.map_editor_view.setScene(self.tile_map_scene)
@@ -415,6 +495,8 @@ class Jide(QMainWindow, Ui_main_window):
         self.tile_pixel_data.data_updated.connect(
             lambda: self.tile_scene.set_image(self.tile_pixel_data.get_image())
         )
+        self.sprite_pixel_data.pixels_updated.connect(self.sprite_scene.update_pixels)
+        self.tile_pixel_data.pixels_updated.connect(self.tile_scene.update_pixels)
 
         self.sprite_color_palette.color_previewed.connect(self.sprite_scene.set_color)
         self.sprite_pixel_palette.assets_selected.connect(self.sprite_scene.select_cells)
@@ -422,7 +504,7 @@ class Jide(QMainWindow, Ui_main_window):
         self.tile_pixel_palette.assets_selected.connect(self.tile_scene.select_cells)
         self.tile_color_palette.color_previewed.connect(
             lambda color, index:
-            self.tile_map_scene.set_color(
+            self.tile_atlas.set_color(
                 self.tile_color_palette.color_palette_name_combo.currentText(),
                 color,
                 index
@@ -446,7 +528,20 @@ class Jide(QMainWindow, Ui_main_window):
         self.tile_color_data.color_updated.connect(
             lambda _, color, index:  self.tile_scene.set_color(color, index)
         )
-        self.tile_color_data.color_updated.connect(self.tile_map_scene.set_color)
+        self.tile_color_data.color_updated.connect(self.tile_atlas.set_color)
+        # Color tables are cached by palette index, which adding, removing
+        # or renaming (moving it to the end) a palette can change
+        self.tile_color_data.color_palette_added.connect(
+            lambda _: self.tile_atlas.reset()
+        )
+        self.tile_color_data.color_palette_removed.connect(
+            lambda _: self.tile_atlas.reset()
+        )
+        self.tile_color_data.color_palette_renamed.connect(
+            lambda *_: self.tile_atlas.reset()
+        )
+        self.tile_pixel_data.pixels_updated.connect(self.tile_atlas.update_pixels)
+        self.tile_pixel_data.data_updated.connect(self.tile_atlas.reset)
 
         self.sprite_color_palette.color_palette_changed.connect(
             lambda palette_name: self.sprite_scene.set_color_table(
@@ -467,11 +562,7 @@ class Jide(QMainWindow, Ui_main_window):
 
         self.tile_map_picker.tile_map_changed.connect(
             lambda tile_map_name: self.tile_map_scene.set_tile_map(
-                RenderedTile.render_tile_map(
-                    self.tile_map_data.get_tile_map(tile_map_name),
-                    self.tile_color_data,
-                    self.tile_pixel_data
-                )
+                self.tile_map_data.get_tile_map(tile_map_name)
             )
         )
 
@@ -480,41 +571,77 @@ class Jide(QMainWindow, Ui_main_window):
             return
 
         self.project_file = file_name
-        project_data = None
+        self.dat_directory = None
+        sections = None
         try:
-            with open(self.project_file, "r") as project_file:
-                project_data = json.load(project_file)
+            if is_binary_project(self.project_file):
+                sections = read_binary_project(self.project_file)
+            else:
+                with open(self.project_file, "r") as project_file:
+                    sections = read_json_project(project_file.read())
 
         except OSError:
             self.show_error_dialog("Unable to open project file")
             return
-        except KeyError:
+        except (KeyError, TypeError, ValueError, struct.error):
             self.show_error_dialog("Unable to load project due to malformed data")
             return
 
-        self.populate_models(project_data)
+        recovered_sections = self.recover_journal(self.project_file)
+        self.journal.set_project_file(self.project_file)
+        self.populate_models(recovered_sections or sections)
         self.enable_ui()
 
+        # Recovered edits are unsaved, so the project starts out modified
+        if recovered_sections:
+            self.undo_stack.resetClean()
+
         self.editor_tabs.setCurrentIndex(0)
 
-    def populate_models(self, project_data):
-        for palette in ColorData.parse_color_data(project_data["sprite_color_palettes"]):
+    def recover_journal(self, project_file):
+        if not Journal.has_journal(project_file):
+            return None
+
+        recover_prompt = QMessageBox()
+        recover_prompt.setIcon(QMessageBox.Question)
+        recover_prompt.setText("Unsaved changes to this project were found from a previous session. Would you like to recover them?")
+        recover_prompt.setWindowTitle("Recover Changes?")
+        recover_prompt.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+
+        recovered_sections = None
+        if recover_prompt.exec() == QMessageBox.Yes:
+            recovered_sections = Journal.recover(project_file)
+            if recovered_sections is None:
+                self.show_error_dialog("Unable to recover changes due to a corrupt journal")
+
+        Journal.remove_journal(project_file)
+        return recovered_sections
+
+    @pyqtSlot(bool)
+    def update_journal(self, clean):
+        if clean:
+            self.journal.discard()
+        else:
+            self.journal.start()
+
+    def populate_models(self, sections):
+        for palette in ColorData.parse_color_data(sections["sprite_color_palettes"]):
             self.sprite_color_data.add_color_palette(*palette)
-        for palette in ColorData.parse_color_data(project_data["tile_color_palettes"]):
+        for palette in ColorData.parse_color_data(sections["tile_color_palettes"]):
             self.tile_color_data.add_color_palette(*palette)
-        sprite_data = PixelData.parse_pixel_data(project_data["sprites"])
-        tile_data = PixelData.parse_pixel_data(project_data["tiles"])
+        sprite_data = sections["sprites"]
+        tile_data = sections["tiles"]
         self.sprite_pixel_data.set_image(*sprite_data[:3])
         self.sprite_pixel_data.set_asset_names(sprite_data[-1])
         self.tile_pixel_data.set_image(*tile_data[:3])
         self.tile_pixel_data.set_asset_names(tile_data[-1])
 
-        for tile_map in project_data["tile_maps"]:
+        for tile_map_name, tile_map_width, tile_map_height, tile_map_words in sections["tile_maps"]:
             self.tile_map_data.add_tile_map(
-                tile_map["name"],
-                tile_map["width"],
-                tile_map["height"],
-                tile_map["contents"]
+                tile_map_name,
+                tile_map_width,
+                tile_map_height,
+                tile_map_words
             )
 
         self.sprite_pixel_palette.pixel_palette_grid.set_asset_names(self.sprite_pixel_data.get_names())
@@ -595,7 +722,7 @@ class Jide(QMainWindow, Ui_main_window):
             self,
             "Open file",
             str(Path(__file__)),
-            "JCAP Resource File (*.jrf)",
+            "JCAP Resource Files (*.jrf *" + binary_extension + ")",
         )
         self.load_project(file_name)
 
@@ -684,7 +811,7 @@ class Jide(QMainWindow, Ui_main_window):
             "tile_maps": tile_maps
         }
 
-        self.populate_models(project_data)
+        self.populate_models(json_to_sections(project_data))
         self.enable_ui()
 
         self.editor_tabs.setFocus()
@@ -694,43 +821,115 @@ class Jide(QMainWindow, Ui_main_window):
         if self.undo_stack.isClean():
             return
 
-        sprites = self.sprite_pixel_data.to_json()
-        tiles = self.tile_pixel_data.to_json()
-        sprite_color_palettes = self.sprite_color_data.to_json()
-        tile_color_palettes = self.tile_color_data.to_json()
-        tile_maps = self.tile_map_data.to_json()
-
-        project_data = {
-            "sprites": sprites,
-            "tiles": tiles,
-            "sprite_color_palettes": sprite_color_palettes,
-            "tile_color_palettes": tile_color_palettes,
-            "tile_maps": tile_maps
-        }
-
         if not self.project_file:
             self.project_file, _ = QFileDialog.getSaveFileName(
                 self, 
                 'Save File',
                 '',
-                'JCAP Resource File (*.jrf)',
+                'JCAP Resource File (*.jrf);;JCAP Resource Binary (*' + binary_extension + ')',
                 options = QFileDialog.Options() | QFileDialog.ReadOnly | QFileDialog.HideNameFilterDetails
             )
 
             if not self.project_file:
                 return
-
+            self.journal.set_project_file(self.project_file)
+
+        # Encode the sections edited since the last save off the GUI thread
+        self.wait_for_save()
+        self.save_thread = threading.Thread(
+            target=self.write_project,
+            args=(
+                self.project_file,
+                self.section_cache.snapshot(is_binary_project(self.project_file)),
+                self.dat_directory,
+                self.section_cache.get_sections() if self.dat_directory else None,
+                self.edit_count
+            ),
+            daemon=True
+        )
+        self.save_thread.start()
+
+    def write_project(self, file_name, snapshot, dat_directory, dat_sections, edit_count):
         try:
-            with open(self.project_file, "w") as project_file:
-                json.dump(project_data, project_file)
+            write_encoded_project(file_name, self.section_cache.encode(snapshot))
+            self.project_saved.emit(edit_count)
+        except Exception as e:
+            # Nothing else would see an error raised on the save thread
+            self.project_save_failed.emit(f"Error while saving the project file: {e}")
+            return
+
+        # Keep previously generated .DAT files in step with the project
+        if dat_directory:
+            try:
+                write_dat_files(dat_directory, dat_sections)
+            except Exception as e:
+                self.project_save_failed.emit(f"Error while generating .DAT files: {e}")
+
+    @pyqtSlot(int)
+    def finish_save(self, edit_count):
+        # Edits made while saving aren't in the file, so it's only clean
+        # if nothing changed since the snapshot
+        if edit_count == self.edit_count:
             self.undo_stack.setClean()
-        except (IOError, PermissionError, OSError) as e:
-            self.show_error_dialog(f"Error while saving the project file: {e}")
+
+    def wait_for_save(self):
+        if self.save_thread is None:
+            return
+
+        self.save_thread.join()
+        self.save_thread = None
+        QApplication.processEvents()
+
+    @pyqtSlot(int)
+    def count_edit(self, _):
+        self.edit_count += 1
+
+    @pyqtSlot()
+    def generate_dat_files(self):
+        directory = QFileDialog.getExistingDirectory(
+            self,
+            "Generate .DAT Files",
+            str(Path(self.project_file).parent) if self.project_file else ""
+        )
+        if not directory:
+            return
+
+        self.wait_for_save()
+        try:
+            write_dat_files(directory, self.section_cache.get_sections())
+            self.dat_directory = directory
+        except (IOError, PermissionError, OSError, ValueError) as e:
+            self.show_error_dialog(f"Error while generating .DAT files: {e}")
+
+    @pyqtSlot()
+    def import_dat_files(self):
+        directory = QFileDialog.getExistingDirectory(self, "Import .DAT Files", "")
+        if not directory:
+            return
+
+        try:
+            sections = read_dat_files(directory)
+        except OSError:
+            self.show_error_dialog("Unable to open .DAT files")
+            return
+        except (KeyError, TypeError, ValueError):
+            self.show_error_dialog("Unable to import .DAT files due to malformed data")
+            return
+
+        if not self.close_project():
+            return
+
+        # The imported project hasn't been saved anywhere yet
+        self.populate_models(sections)
+        self.enable_ui()
+        self.undo_stack.resetClean()
+        self.editor_tabs.setCurrentIndex(0)
 
     @pyqtSlot()
     def close_project(self):
         if not self.check_unsaved_changes():
-            return
+            return False
+        self.wait_for_save()
 
         self.tool_bar.setEnabled(False)
         self.action_save.setEnabled(False)
@@ -755,18 +954,23 @@ class Jide(QMainWindow, Ui_main_window):
         self.tile_pixel_palette.setEnabled(False)
         self.tile_map_picker.setEnabled(False)
 
+        self.journal.close()
         self.undo_stack.clear()
         self.project_file = None
+        self.dat_directory = None
 
         self.init_models()
         self.init_ui()
         self.setup_editor()
+        return True
 
     @pyqtSlot()
     def quit_application(self):
         if not self.check_unsaved_changes():
             return
+        self.wait_for_save()
         
+        self.journal.close()
         self.close()
 
     def check_unsaved_changes(self):
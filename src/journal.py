@@ -0,0 +1,346 @@
+import json
+import os
+import queue
+import struct
+import threading
+import zlib
+from pixel_data import PixelData
+from project_file import (
+    TileMapSource,
+    tile_map_word_bytes
+)
+
+# Record tags; every record carries the sheet it belongs to where relevant
+SHEET_RECORD = b"SHET"
+PIXELS_RECORD = b"PIXL"
+NAMES_RECORD = b"NAME"
+COLORS_RECORD = b"COLR"
+TILE_MAPS_RECORD = b"MAPS"
+
+SPRITES = 0
+TILES = 1
+
+journal_magic = b"JIDEJNL\x02"
+record_header = struct.Struct("<4sII")
+sheet_header = struct.Struct("<BHH")
+pixels_header = struct.Struct("<BHHHH")
+section_header = struct.Struct("<B")
+tile_maps_header = struct.Struct("<I")
+
+class JournalState:
+
+    # The latest contents of each project section, folded from records
+    def __init__(self):
+        self.sheets = {}
+        self.names = {}
+        self.colors = {}
+        self.tile_maps = None
+
+    def apply(self, tag, payload):
+        if tag == SHEET_RECORD:
+            sheet, width, height = sheet_header.unpack_from(payload)
+            self.sheets[sheet] = (width, height, bytearray(payload[sheet_header.size:]))
+        elif tag == PIXELS_RECORD:
+            sheet, x, y, width, height = pixels_header.unpack_from(payload)
+            if sheet not in self.sheets:
+                return
+            sheet_width, _, sheet_pixels = self.sheets[sheet]
+            pixels = payload[pixels_header.size:]
+            for row in range(height):
+                offset = (y + row) * sheet_width + x
+                sheet_pixels[offset:offset + width] = pixels[row * width:(row + 1) * width]
+        elif tag == NAMES_RECORD:
+            self.names[payload[0]] = payload
+        elif tag == COLORS_RECORD:
+            self.colors[payload[0]] = payload
+        elif tag == TILE_MAPS_RECORD:
+            self.tile_maps = payload
+
+    def get_records(self):
+        for sheet, (width, height, pixels) in sorted(self.sheets.items()):
+            yield SHEET_RECORD, sheet_header.pack(sheet, width, height) + pixels
+        for names in self.names.values():
+            yield NAMES_RECORD, names
+        for colors in self.colors.values():
+            yield COLORS_RECORD, colors
+        if self.tile_maps is not None:
+            yield TILE_MAPS_RECORD, self.tile_maps
+
+    def is_complete(self):
+        return (
+            len(self.sheets) == 2 and len(self.names) == 2 and
+            len(self.colors) == 2 and self.tile_maps is not None
+        )
+
+    def to_sections(self):
+        sections = {}
+        for sheet, key in ((SPRITES, "sprites"), (TILES, "tiles")):
+            width, height, pixels = self.sheets[sheet]
+            names = json.loads(self.names[sheet][section_header.size:].decode())
+            sections[key] = (bytes(pixels), width, height, names)
+
+        for sheet, key in ((SPRITES, "sprite_color_palettes"), (TILES, "tile_color_palettes")):
+            sections[key] = json.loads(self.colors[sheet][section_header.size:].decode())
+
+        header_size, = tile_maps_header.unpack_from(self.tile_maps)
+        offset = tile_maps_header.size + header_size
+        sections["tile_maps"] = []
+        for tile_map in json.loads(self.tile_maps[tile_maps_header.size:offset].decode()):
+            contents = bytes(self.tile_maps[offset:offset + tile_map["length"]])
+            offset += tile_map["length"]
+            binary = tile_map["source"] == "binary"
+            sections["tile_maps"].append((
+                tile_map["name"],
+                tile_map["width"],
+                tile_map["height"],
+                TileMapSource(
+                    contents if binary else contents.decode(),
+                    binary,
+                    tile_map["width"] * tile_map["height"]
+                )
+            ))
+
+        return sections
+
+class Journal:
+
+    # Appended bytes after which the journal is rewritten as a snapshot
+    compaction_threshold = 4 * 1024 * 1024
+
+    def __init__(
+            self,
+            sprite_pixel_data,
+            tile_pixel_data,
+            sprite_color_data,
+            tile_color_data,
+            tile_map_data
+        ):
+        self.pixel_data = {SPRITES: sprite_pixel_data, TILES: tile_pixel_data}
+        self.color_data = {SPRITES: sprite_color_data, TILES: tile_color_data}
+        self.tile_map_data = tile_map_data
+        self.project_file = None
+        self.active = False
+        self.commands = queue.Queue()
+        self.writer = None
+
+        for sheet, pixel_data in self.pixel_data.items():
+            pixel_data.pixels_updated.connect(
+                lambda rect, sheet=sheet:
+                self.record(PIXELS_RECORD, self.encode_pixels, sheet, rect)
+            )
+            pixel_data.data_updated.connect(
+                lambda sheet=sheet: self.record(SHEET_RECORD, self.encode_sheet, sheet)
+            )
+            pixel_data.name_updated.connect(
+                lambda *_, sheet=sheet: self.record(NAMES_RECORD, self.encode_names, sheet)
+            )
+        for sheet, color_data in self.color_data.items():
+            for signal in (
+                color_data.color_palette_added,
+                color_data.color_palette_removed,
+                color_data.color_palette_renamed,
+                color_data.color_updated
+            ):
+                signal.connect(
+                    lambda *_, sheet=sheet: self.record(COLORS_RECORD, self.encode_colors, sheet)
+                )
+        for signal in (
+            tile_map_data.tile_map_added,
+            tile_map_data.tile_map_removed,
+            tile_map_data.tile_map_renamed
+        ):
+            signal.connect(lambda *_: self.record(TILE_MAPS_RECORD, self.encode_tile_maps))
+
+    @staticmethod
+    def journal_path(project_file):
+        return project_file + ".journal"
+
+    @staticmethod
+    def has_journal(project_file):
+        return os.path.isfile(Journal.journal_path(project_file))
+
+    @staticmethod
+    def read_records(journal_file):
+        # Stops at the first torn or corrupt record, i.e. wherever a crash
+        # interrupted the last write
+        with open(journal_file, "rb") as journal:
+            if journal.read(len(journal_magic)) != journal_magic:
+                return
+            while True:
+                header = journal.read(record_header.size)
+                if len(header) < record_header.size:
+                    return
+                tag, length, checksum = record_header.unpack(header)
+                payload = journal.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+                yield tag, payload
+
+    @staticmethod
+    def recover(project_file):
+        state = JournalState()
+        try:
+            for tag, payload in Journal.read_records(Journal.journal_path(project_file)):
+                state.apply(tag, payload)
+        except OSError:
+            return None
+
+        return state.to_sections() if state.is_complete() else None
+
+    @staticmethod
+    def remove_journal(project_file):
+        try:
+            os.remove(Journal.journal_path(project_file))
+        except OSError:
+            pass
+
+    def set_project_file(self, project_file):
+        self.discard()
+        self.project_file = project_file
+
+    def start(self):
+        if self.active or not self.project_file:
+            return
+
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_commands, daemon=True)
+            self.writer.start()
+
+        # The first records hold the whole project, later ones only changes
+        base_records = [(SHEET_RECORD, self.encode_sheet(sheet)) for sheet in self.pixel_data]
+        base_records += [(NAMES_RECORD, self.encode_names(sheet)) for sheet in self.pixel_data]
+        base_records += [(COLORS_RECORD, self.encode_colors(sheet)) for sheet in self.color_data]
+        base_records.append((TILE_MAPS_RECORD, self.encode_tile_maps()))
+        self.commands.put(("start", Journal.journal_path(self.project_file), base_records))
+        self.active = True
+
+    def discard(self):
+        if not self.active:
+            return
+
+        self.commands.put(("discard",))
+        self.active = False
+
+    def close(self):
+        self.discard()
+        if self.writer is not None:
+            self.commands.put(("stop",))
+            self.writer.join()
+            self.writer = None
+
+    def record(self, tag, encode, *args):
+        # Only encoded while journaling, so edits to a clean project and
+        # loading a project cost nothing here
+        if self.active:
+            self.commands.put(("record", tag, encode(*args)))
+
+    def encode_sheet(self, sheet):
+        pixel_data = self.pixel_data[sheet]
+        image = pixel_data.get_image()
+        return (
+            sheet_header.pack(sheet, image.width(), image.height()) +
+            pixel_data.get_packed_pixels()
+        )
+
+    def encode_pixels(self, sheet, rect):
+        image = self.pixel_data[sheet].get_image()
+        rect = rect.intersected(image.rect())
+        buffer = PixelData.image_buffer(image, writable=False)
+        stride = image.bytesPerLine()
+        pixels = b"".join(
+            buffer[y * stride + rect.left():y * stride + rect.left() + rect.width()]
+            for y in range(rect.top(), rect.bottom() + 1)
+        )
+        return pixels_header.pack(sheet, rect.x(), rect.y(), rect.width(), rect.height()) + pixels
+
+    def encode_names(self, sheet):
+        return section_header.pack(sheet) + json.dumps(self.pixel_data[sheet].get_names()).encode()
+
+    def encode_colors(self, sheet):
+        return section_header.pack(sheet) + json.dumps(self.color_data[sheet].to_json()).encode()
+
+    def encode_tile_maps(self):
+        # Tile maps yet to be decoded, or which failed to, are journaled as
+        # their source from the project file rather than being decoded here
+        tile_maps = []
+        contents = []
+        for tile_map in self.tile_map_data.get_tile_maps():
+            source = tile_map.get_source()
+            if source is None:
+                binary, tile_map_contents = True, tile_map_word_bytes(tile_map.get_data())
+            elif source.binary:
+                binary, tile_map_contents = True, source.contents
+            else:
+                binary, tile_map_contents = False, source.contents.encode()
+            tile_maps.append({
+                "name": tile_map.get_name(),
+                "width": tile_map.get_width(),
+                "height": tile_map.get_height(),
+                "source": "binary" if binary else "json",
+                "length": len(tile_map_contents)
+            })
+            contents.append(tile_map_contents)
+
+        header = json.dumps(tile_maps).encode()
+        return tile_maps_header.pack(len(header)) + header + b"".join(contents)
+
+    def write_commands(self):
+        # Runs on the writer thread, which alone owns the file and state
+        journal = None
+        journal_file = None
+        state = JournalState()
+        appended = 0
+
+        while True:
+            command = self.commands.get()
+            try:
+                if command[0] == "start":
+                    _, journal_file, base_records = command
+                    state = JournalState()
+                    for tag, payload in base_records:
+                        state.apply(tag, payload)
+                    journal = Journal.write_snapshot(journal_file, state)
+                    appended = 0
+                elif command[0] == "record" and journal is not None:
+                    _, tag, payload = command
+                    state.apply(tag, payload)
+                    journal.write(
+                        record_header.pack(tag, len(payload), zlib.crc32(payload)) + payload
+                    )
+                    appended += record_header.size + len(payload)
+                    if appended > Journal.compaction_threshold:
+                        journal.close()
+                        journal = Journal.write_snapshot(journal_file, state)
+                        appended = 0
+                elif command[0] in ("discard", "stop") and journal is not None:
+                    journal.close()
+                    journal = None
+                    os.remove(journal_file)
+            except OSError:
+                journal = None
+
+            if command[0] == "stop":
+                return
+
+            # Sync once the queue drains rather than after every record
+            if journal is not None and self.commands.empty():
+                try:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                except OSError:
+                    journal = None
+
+    @staticmethod
+    def write_snapshot(journal_file, state):
+        # Written beside the journal and swapped in, so a crash mid-compaction
+        # leaves the previous journal intact
+        snapshot_file = journal_file + ".tmp"
+        with open(snapshot_file, "wb") as snapshot:
+            snapshot.write(journal_magic)
+            for tag, payload in state.get_records():
+                snapshot.write(record_header.pack(tag, len(payload), zlib.crc32(payload)) + payload)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(snapshot_file, journal_file)
+
+        return open(journal_file, "ab")
@@ -1,57 +1,63 @@
 import math
 from PyQt5.QtCore import (
     Qt,
-    QRect, 
+    QRect,
+    QRectF,
     pyqtSlot
 )
 from PyQt5.QtGui import (
-    QPixmap,
     QPainter,
-    QImage, 
-    QColor,
     QPen
 )
 from PyQt5.QtWidgets import (
     QGraphicsScene,
-    QGraphicsPixmapItem
+    QGraphicsItem
 )
+from tile_map_data import TileMap
 
 class MapEditorScene(QGraphicsScene):
 
-    def __init__(self, parent=None):
+    def __init__(self, tile_atlas, parent=None):
         super().__init__(parent)
-        self.subject = QImage()
-        self.crop_rect = QRect()
-        self.tile_map_images = []
+        self.tile_atlas = tile_atlas
+        self.tile_map_item = None
+
+        self.tile_atlas.tiles_updated.connect(self.update_tiles)
+        self.tile_atlas.color_updated.connect(self.update_color)
+        self.tile_atlas.atlas_reset.connect(self.refresh_tile_map)
 
     @pyqtSlot()
-    def set_tile_map(self, tile_map_images):
-        self.tile_map_images = tile_map_images
-        self.refresh_tile_map()
+    def set_tile_map(self, tile_map):
+        if self.tile_map_item is not None:
+            self.removeItem(self.tile_map_item)
+            self.tile_map_item = None
 
-    def refresh_tile_map(self):
-        self.clear()
-        x, y = 0, 0
-        for row in self.tile_map_images:
-            for tile in row:
-                pixmap = QPixmap.fromImage(tile)
-                item = QGraphicsPixmapItem(pixmap)
-                item.setPos(x, y)
-                self.addItem(item)
-                x += pixmap.width()
-
-            x = 0
-            y += pixmap.height()
+        if tile_map is not None:
+            self.tile_map_item = TileMapItem(tile_map, self.tile_atlas)
+            self.addItem(self.tile_map_item)
 
         self.setSceneRect(self.itemsBoundingRect())
 
-    @pyqtSlot(str, QColor, int)
-    def set_color(self, color_palette, color, index):
-        for tile in [tile for row in self.tile_map_images for tile in row]:
-            if tile.color_palette_name == color_palette:
-                tile.setColor(index, color.rgb())
+    def refresh_tile_map(self):
+        if self.tile_map_item is not None:
+            self.tile_map_item.update()
 
-        self.refresh_tile_map()
+    @pyqtSlot(list)
+    def update_tiles(self, tile_palette_indices):
+        if self.tile_map_item is not None:
+            updated = set(tile_palette_indices)
+            self.tile_map_item.update_cells(
+                lambda tile: tile.tile_palette_index in updated
+            )
+
+    @pyqtSlot(int, int)
+    def update_color(self, color_palette_index, index):
+        if self.tile_map_item is not None:
+            self.tile_map_item.update_cells(
+                lambda tile:
+                tile.color_palette_index == color_palette_index and
+                index in self.tile_atlas.get_tile_colors(tile.tile_palette_index)
+            )
 
     def drawForeground(self, painter, rect):
         super().drawBackground(painter, rect)
@@ -90,27 +96,89 @@ class MapEditorScene(QGraphicsScene):
             painter.drawLine(left, y, right, y)
             y += grid_size
 
-class RenderedTile(QImage):
-
-    def __init__(self, tile_image, color_palette_name, tile_palette_index):
-        super().__init__(tile_image)
-        self.color_palette_name = color_palette_name
-        self.tile_palette_index = tile_palette_index
-
-    @staticmethod
-    def render_tile_map(tile_map_data, color_palette_data, tile_palette_data):
-        map_height = tile_map_data.get_height()
-        map_width = tile_map_data.get_width()
-        tile_map_images = [[None for _ in range(map_width)] for _ in range(map_height)]
-        for row in range(map_height):
-            for col in range(map_width):
-                tile = tile_map_data.get_tile(col, row)
-                color_palette_index = tile.color_palette_index
-                tile_palette_index = tile.tile_palette_index
-                tile_image = tile_palette_data.get_asset(tile_palette_index)
-                color_palette_name = color_palette_data.get_color_palette_name(color_palette_index)
-                color_palette = color_palette_data.get_color_palette(color_palette_name)
-                tile_image.setColorTable([color.rgb() for color in color_palette])
-                tile_map_images[row][col] = RenderedTile(tile_image, color_palette_name, tile_palette_index)
-
-        return tile_map_images
+class TileMapItem(QGraphicsItem):
+
+    tile_size = 8
+
+    def __init__(self, tile_map, tile_atlas, parent=None):
+        super().__init__(parent)
+        self.tile_map = tile_map
+        self.tile_atlas = tile_atlas
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(
+            0,
+            0,
+            self.tile_map.get_width() * TileMapItem.tile_size,
+            self.tile_map.get_height() * TileMapItem.tile_size
+        )
+
+    def paint(self, painter, option, widget):
+        # Only draw the cells intersecting the exposed area of the view
+        exposed_rect = option.exposedRect.toAlignedRect().intersected(
+            self.boundingRect().toAlignedRect()
+        )
+        if exposed_rect.isEmpty():
+            return
+
+        for row in range(exposed_rect.top() // TileMapItem.tile_size, exposed_rect.bottom() // TileMapItem.tile_size + 1):
+            for col in range(exposed_rect.left() // TileMapItem.tile_size, exposed_rect.right() // TileMapItem.tile_size + 1):
+                tile = self.tile_map.get_tile(col, row)
+                painter.drawPixmap(
+                    col * TileMapItem.tile_size,
+                    row * TileMapItem.tile_size,
+                    self.tile_atlas.get_tile(tile.tile_palette_index, tile.color_palette_index)
+                )
+
+    def update_cells(self, is_updated):
+        # Nothing has been drawn from a tile map which isn't loaded yet
+        if not self.tile_map.is_loaded():
+            return
+
+        # Repaint the chunks containing a tile which matches, testing each
+        # distinct tile word in the tile map once
+        updated_chunks = set()
+        for tile_word, chunk_positions in self.tile_map.get_tile_word_chunks().items():
+            if is_updated(TileMap.unpack_tile(tile_word)):
+                updated_chunks.update(chunk_positions)
+
+        # Blank chunks aren't stored, but are filled with tile word 0
+        chunk_columns, chunk_rows = self.tile_map.get_chunk_grid_size()
+        if is_updated(TileMap.unpack_tile(0)):
+            updated_chunks.update(
+                (chunk_x, chunk_y)
+                for chunk_y in range(chunk_rows)
+                for chunk_x in range(chunk_columns)
+                if self.tile_map.get_chunk(chunk_x, chunk_y) is None
+            )
+
+        chunk_size = TileMap.chunk_size
+        updated_rect = QRect()
+        for chunk_x, chunk_y in updated_chunks:
+            updated_rect = updated_rect.united(
+                QRect(chunk_x * chunk_size, chunk_y * chunk_size, chunk_size, chunk_size)
+            )
+
+        updated_rect = updated_rect.intersected(
+            QRect(0, 0, self.tile_map.get_width(), self.tile_map.get_height())
+        )
+        if not updated_rect.isEmpty():
+            self.update(
+                QRectF(
+                    updated_rect.x() * TileMapItem.tile_size,
+                    updated_rect.y() * TileMapItem.tile_size,
+                    updated_rect.width() * TileMapItem.tile_size,
+                    updated_rect.height() * TileMapItem.tile_size
+                )
+            )
+
+    def update_tile(self, col, row):
+        self.update(
+            QRectF(
+                col * TileMapItem.tile_size,
+                row * TileMapItem.tile_size,
+                TileMapItem.tile_size,
+                TileMapItem.tile_size
+            )
+        )
@@ -1,4 +1,8 @@
 import math
+import re
+import time
+import zlib
+from array import array
 from PyQt5.QtCore import (
     QObject,
     pyqtSignal,
@@ -6,11 +10,19 @@ from PyQt5.QtCore import (
 )
 from PyQt5.QtGui import QImage
 from PyQt5.QtWidgets import QUndoCommand
-from undo_stack import Validator
+from PyQt5 import sip
+from undo_stack import (
+    Validator,
+    CommandId
+)
+
+# Runs of pixels which aren't the transparent index (16) in a stroke image
+opaque_runs = re.compile(rb"[^\x10]+")
 
 class PixelData(QObject):
 
     data_updated = pyqtSignal()
+    pixels_updated = pyqtSignal(QRect)
     name_updated = pyqtSignal(int, str)
 
     pixels_per_asset = 64
@@ -23,33 +35,98 @@ class PixelData(QObject):
         super().__init__()
         self.data = QImage()
         self.names = []
+        self.asset_cache = {}
 
     def set_image(self, data, width, height):
         original_color_table = self.data.colorTable()
-        self.data = QImage(data, width, height, QImage.Format_Indexed8)
-        self.set_color_table(original_color_table)
+        self.data = QImage(data, width, height, QImage.Format_Indexed8).copy()
+        self.data.setColorTable(original_color_table)
+        self.asset_cache.clear()
+        self.data_updated.emit()
 
     def get_image(self):
         return self.data
 
-    def get_asset(self, asset_index):
-        tiles_per_row = self.data.width() // PixelData.asset_width
+    def get_buffer(self):
+        return PixelData.image_buffer(self.data)
+
+    @staticmethod
+    def image_buffer(image, writable=True):
+        # Zero-copy view of an image's pixel indices; bits() detaches shared images
+        if image.isNull():
+            return memoryview(bytearray())
+        buffer = image.bits() if writable else image.constBits()
+        buffer.setsize(image.sizeInBytes())
+        return memoryview(buffer)
+
+    def get_packed_pixels(self):
+        # The sheet's pixel indices without any scanline padding
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        if stride == self.data.width():
+            return buffer.tobytes()
+
+        return b"".join(buffer[y * stride:y * stride + self.data.width()] for y in range(self.data.height()))
+
+    def get_asset_origin(self, asset_index):
+        assets_per_row = self.data.width() // PixelData.asset_width
+        return (
+            (asset_index % assets_per_row) * PixelData.asset_width,
+            (asset_index // assets_per_row) * PixelData.asset_height
+        )
 
-        # Calculate the starting pixel coordinates of the specified tile
-        start_x = (asset_index % tiles_per_row) * PixelData.asset_width
-        start_y = (asset_index // tiles_per_row) * PixelData.asset_height
+    def get_asset_count(self):
+        return (self.data.width() // PixelData.asset_width) * (self.data.height() // PixelData.asset_height)
 
-        # Create a new QImage for the tile
-        asset = QImage(PixelData.asset_width, PixelData.asset_height, QImage.Format_Indexed8)
-        asset.setColorCount(PixelData.color_table_depth)
-        
-        # Copy the pixel data from the original image to the tile image
-        for y in range(PixelData.asset_height):
-            for x in range(PixelData.asset_width):
-                pixel_color = self.data.pixelIndex(start_x + x, start_y + y)
-                asset.setPixel(x, y, pixel_color)
+    def get_asset_indices(self, rect):
+        assets_per_row = self.data.width() // PixelData.asset_width
+        rect = rect.intersected(self.data.rect())
+        if rect.isEmpty():
+            return []
 
-        return asset
+        return [
+            row * assets_per_row + col
+            for row in range(rect.top() // PixelData.asset_height, rect.bottom() // PixelData.asset_height + 1)
+            for col in range(rect.left() // PixelData.asset_width, rect.right() // PixelData.asset_width + 1)
+        ]
+
+    def get_asset(self, asset_index):
+        # Cached assets are shared, so callers modifying the returned
+        # image (e.g. its color table) detach from the cached copy
+        if asset_index not in self.asset_cache:
+            self.asset_cache[asset_index] = self.data.copy(
+                *self.get_asset_origin(asset_index),
+                PixelData.asset_width,
+                PixelData.asset_height
+            )
+
+        return QImage(self.asset_cache[asset_index])
+
+    def get_asset_pixels(self, asset_index):
+        start_x, start_y = self.get_asset_origin(asset_index)
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        offset = start_y * stride + start_x
+
+        return b"".join(
+            buffer[offset + row * stride:offset + row * stride + PixelData.asset_width]
+            for row in range(PixelData.asset_height)
+        )
+
+    def get_asset_view(self, asset_index):
+        # Wraps the sheet's own buffer, so the view must not outlive the
+        # next add_palette_row/remove_palette_row/set_image call
+        start_x, start_y = self.get_asset_origin(asset_index)
+        stride = self.data.bytesPerLine()
+        address = int(self.data.bits()) + start_y * stride + start_x
+
+        return QImage(
+            sip.voidptr(address),
+            PixelData.asset_width,
+            PixelData.asset_height,
+            stride,
+            QImage.Format_Indexed8
+        )
 
     def set_asset_names(self, names):
         self.names = names
@@ -65,106 +142,265 @@ class PixelData(QObject):
         return self.names[asset_index]
 
     def set_color_table(self, color_table):
+        # No pixels change, and views track the colors themselves, so this
+        # isn't reported as a pixel edit
         self.data.setColorTable(color_table)
-        self.data_updated.emit()
+        self.asset_cache.clear()
 
     def set_pixels(self, new_pixels, selection):
-        for y in range(selection.top(), selection.bottom()):
-            for x in range(selection.left(), selection.right()):
-                pixel_index = new_pixels.pixelIndex(x - selection.left(), y - selection.top())
-                if pixel_index != 16:
-                    self.data.setPixel(x, y, pixel_index)
-
-        self.data_updated.emit()
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        new_buffer = PixelData.image_buffer(new_pixels, writable=False)
+        new_stride = new_pixels.bytesPerLine()
+        left = max(selection.left(), 0)
+        top = max(selection.top(), 0)
+        right = min(selection.left() + selection.width(), self.data.width(), selection.left() + new_pixels.width())
+        bottom = min(selection.top() + selection.height(), self.data.height(), selection.top() + new_pixels.height())
+
+        # Copy each opaque run of the new pixels in a single slice, leaving
+        # pixels under transparent (index 16) runs untouched
+        for y in range(top, bottom):
+            row_start = (y - selection.top()) * new_stride + left - selection.left()
+            row = new_buffer[row_start:row_start + right - left]
+            offset = y * stride + left
+            for run in opaque_runs.finditer(row):
+                start, end = run.span()
+                buffer[offset + start:offset + end] = row[start:end]
+
+        updated_rect = QRect(left, top, right - left, bottom - top)
+        for asset_index in self.get_asset_indices(updated_rect):
+            self.asset_cache.pop(asset_index, None)
+
+        self.pixels_updated.emit(updated_rect)
 
     def get_pixels(self, selection):
         return self.data.copy(selection)
 
+    def get_pixel_delta(self, new_pixels, selection):
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        new_buffer = PixelData.image_buffer(new_pixels, writable=False)
+        new_stride = new_pixels.bytesPerLine()
+        left = max(selection.left(), 0)
+        top = max(selection.top(), 0)
+        right = min(selection.left() + selection.width(), self.data.width(), selection.left() + new_pixels.width())
+        bottom = min(selection.top() + selection.height(), self.data.height(), selection.top() + new_pixels.height())
+        positions = array("H")
+        old_pixels = bytearray()
+        changed_pixels = bytearray()
+
+        # Keep only the opaque runs which actually change the sheet
+        for y in range(top, bottom):
+            row_start = (y - selection.top()) * new_stride + left - selection.left()
+            row = new_buffer[row_start:row_start + right - left]
+            offset = y * stride + left
+            for run in opaque_runs.finditer(row):
+                start, end = run.span()
+                old_run = buffer[offset + start:offset + end]
+                if old_run == row[start:end]:
+                    continue
+                positions.extend((left + start, y, end - start))
+                old_pixels += old_run
+                changed_pixels += row[start:end]
+
+        return PixelDelta(positions, bytes(old_pixels), bytes(changed_pixels))
+
+    def get_color_delta(self, old_color_index, new_color_index, selection):
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        selection = selection.intersected(self.data.rect())
+        color_runs = re.compile(re.escape(bytes([old_color_index])) + b"+")
+        positions = array("H")
+
+        for y in range(selection.top(), selection.bottom() + 1):
+            offset = y * stride + selection.left()
+            for run in color_runs.finditer(buffer[offset:offset + selection.width()]):
+                positions.extend((selection.left() + run.start(), y, run.end() - run.start()))
+
+        pixel_count = sum(positions[2::3])
+        return PixelDelta(positions, bytes([old_color_index]) * pixel_count, bytes([new_color_index]) * pixel_count)
+
+    def set_pixel_runs(self, positions, pixels):
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        pixel_offset = 0
+        left, top = self.data.width(), self.data.height()
+        right, bottom = 0, 0
+
+        for index in range(0, len(positions), 3):
+            x, y, length = positions[index:index + 3]
+            offset = y * stride + x
+            buffer[offset:offset + length] = pixels[pixel_offset:pixel_offset + length]
+            pixel_offset += length
+            left, top = min(left, x), min(top, y)
+            right, bottom = max(right, x + length), max(bottom, y + 1)
+
+        updated_rect = QRect(left, top, right - left, bottom - top)
+        for asset_index in self.get_asset_indices(updated_rect):
+            self.asset_cache.pop(asset_index, None)
+
+        self.pixels_updated.emit(updated_rect)
+
+    def replace_color(self, old_color_index, new_color_index, selection):
+        buffer = self.get_buffer()
+        stride = self.data.bytesPerLine()
+        selection = selection.intersected(self.data.rect())
+        translation = bytearray(range(256))
+        translation[old_color_index] = new_color_index
+
+        # Translate the whole sheet in one pass, or each selected row in one slice
+        if selection == self.data.rect():
+            buffer[:] = buffer.tobytes().translate(translation)
+        else:
+            for y in range(selection.top(), selection.bottom() + 1):
+                offset = y * stride + selection.left()
+                row = buffer[offset:offset + selection.width()]
+                row[:] = row.tobytes().translate(translation)
+
+        for asset_index in self.get_asset_indices(selection):
+            self.asset_cache.pop(asset_index, None)
+
+        self.pixels_updated.emit(selection)
+
     def add_palette_row(self, row_data = None):
-        new_image = QImage(self.data.width(), self.data.height() + 8, QImage.Format_Indexed8)
+        new_image = QImage(self.data.width(), self.data.height() + PixelData.asset_height, QImage.Format_Indexed8)
         new_image.setColorTable(self.data.colorTable())
+        new_buffer = PixelData.image_buffer(new_image)
+        row_offset = self.data.sizeInBytes()
 
-        for y in range(new_image.height()):
-            for x in range(new_image.width()):
-                if y >= self.data.height():
-                    if row_data is None:
-                        new_image.setPixel(x, y, 0)
-                    else:
-                        new_image.setPixel(
-                            x,
-                            y,
-                            row_data.pixelIndex(x, y - (new_image.height() - 8))
-                        )
-                else:
-                    new_image.setPixel(x, y, self.data.pixelIndex(x, y))
+        new_buffer[:row_offset] = self.get_buffer()
+        if row_data is None:
+            new_buffer[row_offset:] = bytes(len(new_buffer) - row_offset)
+        else:
+            new_buffer[row_offset:] = PixelData.image_buffer(row_data, writable=False)
 
         self.data = new_image
+        self.asset_cache.clear()
 
         self.data_updated.emit()
 
     def remove_palette_row(self):
-        new_image = QImage(self.data.width(), self.data.height() - 8, QImage.Format_Indexed8)
-        new_image.setColorTable(self.data.colorTable())
-        row_image = QImage(self.data.width(), 8, QImage.Format_Indexed8)
-        row_image.setColorTable(self.data.colorTable())
-
-        for y in range(new_image.height(), self.data.height()):
-            for x in range(self.data.width()):
-                row_image.setPixel(x, y - (self.data.height() - 8), self.data.pixelIndex(x, y))
+        new_height = self.data.height() - PixelData.asset_height
+        row_image = self.data.copy(0, new_height, self.data.width(), PixelData.asset_height)
 
-        for y in range(new_image.height()):
-            for x in range(new_image.width()):
-                new_image.setPixel(x, y, self.data.pixelIndex(x, y))
-
-        self.data = new_image
+        self.data = self.data.copy(0, 0, self.data.width(), new_height)
+        self.asset_cache.clear()
         self.data_updated.emit()
         return row_image
-    
+
     def to_json(self):
-        image_data = []
-        name_index = 0
-
-        # Iterate through the image, dividing it into tiles
-        for y in range(0, self.data.height(), PixelData.asset_height):
-            for x in range(0, self.data.width(), PixelData.asset_width):
-                tile_data = []
-
-                # Extract pixel data for the current tile
-                for row in range(PixelData.asset_height):
-                    row_data = []
-                    for col in range(PixelData.asset_width):
-                        # Append the RGB color tuple to the row data
-                        row_data.append(self.data.pixelIndex(x + col, y + row))
-                    # Append the row data to the tile data
-                    tile_data.append(row_data)
-
-                # Create a JSON representation of the tile and add it to the list
-                asset = {
-                    "name": self.names[name_index],
-                    "contents": tile_data
-                }
-                image_data.append(asset)
-                name_index += 1
-
-        return image_data
+        return list(PixelData.iter_json_assets(self.get_packed_pixels(), self.data.width(), self.data.height(), self.names))
+
+    @staticmethod
+    def iter_json_assets(pixels, width, height, names):
+        # Split the sheet into 8 pixel asset rows in one pass; an asset's
+        # rows are then every assets_per_row'th row from its first one
+        assets_per_row = width // PixelData.asset_width
+        rows_per_asset_row = assets_per_row * PixelData.asset_height
+        rows = [
+            list(pixels[offset:offset + PixelData.asset_width])
+            for offset in range(0, width * height, PixelData.asset_width)
+        ]
+
+        for asset_index in range(assets_per_row * (height // PixelData.asset_height)):
+            first_row = (asset_index // assets_per_row) * rows_per_asset_row + asset_index % assets_per_row
+            yield {
+                "name": names[asset_index],
+                "contents": rows[first_row:first_row + rows_per_asset_row:assets_per_row]
+            }
 
     @staticmethod
     def parse_pixel_data(data):
-        pixel_data = bytearray([0] * len(data) * PixelData.pixels_per_asset)
+        # Inverse of iter_json_assets: slot each asset's rows into the
+        # sheet's row list, then join them into the pixel buffer at once
+        assets_per_row = PixelData.assets_per_line
+        rows_per_asset_row = assets_per_row * PixelData.asset_height
+        asset_rows = math.ceil(len(data) / assets_per_row)
+        rows = [bytes(PixelData.asset_width)] * (asset_rows * rows_per_asset_row)
         names = []
 
-        for index, palette in enumerate(data):
-            names.append(palette["name"])
-            col_index = math.floor(index / PixelData.assets_per_line) * PixelData.asset_width * PixelData.assets_per_line * PixelData.asset_height
-            col_offset = (index % PixelData.assets_per_line) * PixelData.asset_width
-            for pixel_row, pixel_row_data in enumerate(palette["contents"]):
-                row_offset = pixel_row * PixelData.assets_per_line * PixelData.asset_width
-                pixel_data_index = col_index + row_offset + col_offset
-                pixel_data[pixel_data_index:pixel_data_index + 8] = pixel_row_data
+        for index, asset in enumerate(data):
+            names.append(asset["name"])
+            first_row = (index // assets_per_row) * rows_per_asset_row + index % assets_per_row
+            rows[first_row:first_row + rows_per_asset_row:assets_per_row] = map(bytes, asset["contents"])
 
-        width = PixelData.asset_width * PixelData.assets_per_line
-        height = math.ceil(len(pixel_data) / width)
-        return (pixel_data, width, height, names)
+        width = PixelData.asset_width * assets_per_row
+        height = asset_rows * PixelData.asset_height
+        return (b"".join(rows), width, height, names)
+
+class PixelDelta:
+
+    def __init__(self, positions, old_pixels, new_pixels):
+        # Runs of changed pixels as flat (x, y, length) triples, alongside
+        # the pixels each run held before and after the edit
+        self.positions = positions
+        self.old_pixels = old_pixels
+        self.new_pixels = new_pixels
+        self.compressed = False
+
+    def is_empty(self):
+        return len(self.positions) == 0
+
+    def byte_size(self):
+        if self.compressed:
+            return len(self.positions) + len(self.old_pixels) + len(self.new_pixels)
+
+        return len(self.positions) * self.positions.itemsize + len(self.old_pixels) + len(self.new_pixels)
+
+    def compress(self):
+        if self.compressed:
+            return
+
+        self.positions = zlib.compress(self.positions.tobytes())
+        self.old_pixels = zlib.compress(self.old_pixels)
+        self.new_pixels = zlib.compress(self.new_pixels)
+        self.compressed = True
+
+    def get_positions(self):
+        if not self.compressed:
+            return self.positions
+
+        positions = array("H")
+        positions.frombytes(zlib.decompress(self.positions))
+        return positions
+
+    def get_old_pixels(self):
+        return zlib.decompress(self.old_pixels) if self.compressed else self.old_pixels
+
+    def get_new_pixels(self):
+        return zlib.decompress(self.new_pixels) if self.compressed else self.new_pixels
+
+    def merge(self, later_delta):
+        # Compose with a later edit: each pixel keeps its earliest old value
+        # and its latest new value, and pixels changed back are dropped
+        pixels = {}
+        for delta in (self, later_delta):
+            positions = delta.get_positions()
+            old_pixels = delta.get_old_pixels()
+            new_pixels = delta.get_new_pixels()
+            pixel_offset = 0
+            for index in range(0, len(positions), 3):
+                x, y, length = positions[index:index + 3]
+                for run_index in range(length):
+                    key = (y, x + run_index)
+                    old_pixel = pixels[key][0] if key in pixels else old_pixels[pixel_offset + run_index]
+                    pixels[key] = (old_pixel, new_pixels[pixel_offset + run_index])
+                pixel_offset += length
+
+        positions = array("H")
+        old_pixels = bytearray()
+        new_pixels = bytearray()
+        for (y, x), (old_pixel, new_pixel) in sorted(pixels.items()):
+            if old_pixel == new_pixel:
+                continue
+            if positions and positions[-2] == y and positions[-3] + positions[-1] == x:
+                positions[-1] += 1
+            else:
+                positions.extend((x, y, 1))
+            old_pixels.append(old_pixel)
+            new_pixels.append(new_pixel)
+
+        return PixelDelta(positions, bytes(old_pixels), bytes(new_pixels))
 
 class cmd_add_pixel_palette_row(QUndoCommand):
 
@@ -215,6 +451,17 @@ class cmd_set_asset_name(QUndoCommand):
     def undo(self):
         self.data_source.set_asset_name(self.asset_index, self.old_asset_name)
 
+    def id(self):
+        return CommandId.SET_ASSET_NAME
+
+    def mergeWith(self, other):
+        if other.data_source is not self.data_source or other.asset_index != self.asset_index:
+            return False
+
+        self.new_asset_name = other.new_asset_name
+        self.setObsolete(self.new_asset_name == self.old_asset_name)
+        return True
+
     def validate(self):
         if self.old_asset_name == self.new_asset_name:
             return Validator(False, "")
@@ -227,24 +474,104 @@ class cmd_set_asset_name(QUndoCommand):
 
 class cmd_set_pixels(QUndoCommand):
 
-    def __init__(self, data_source, new_pixels, selection, parent=None):
+    # Seconds between consecutive edits of the same selection for them to
+    # be undone as one
+    merge_window = 0.5
+
+    def __init__(self, data_source, new_pixels, selection, origin, parent=None):
         super().__init__("set pixels", parent)
         self.data_source = data_source
-        self.new_pixels = new_pixels
+        self.asset_selection = QRect(selection)
+        self.timestamp = time.monotonic()
         scale_factor = 8
         self.selection = QRect(
-            selection.x() * scale_factor,
-            selection.y() * scale_factor,
-            selection.width() * scale_factor + 1,
-            selection.height() * scale_factor + 1
+            selection.x() * scale_factor + origin.x(),
+            selection.y() * scale_factor + origin.y(),
+            new_pixels.width(),
+            new_pixels.height()
         )
-        self.original_pixels = data_source.get_pixels(self.selection)
+        self.delta = data_source.get_pixel_delta(new_pixels, self.selection)
+
+    def redo(self):
+        self.data_source.set_pixel_runs(self.delta.get_positions(), self.delta.get_new_pixels())
+
+    def undo(self):
+        self.data_source.set_pixel_runs(self.delta.get_positions(), self.delta.get_old_pixels())
+
+    def id(self):
+        return CommandId.SET_PIXELS
+
+    def mergeWith(self, other):
+        if (other.data_source is not self.data_source or
+            other.asset_selection != self.asset_selection or
+            other.timestamp - self.timestamp > cmd_set_pixels.merge_window):
+            return False
+
+        self.delta = self.delta.merge(other.delta)
+        self.timestamp = other.timestamp
+        self.setObsolete(self.delta.is_empty())
+        return True
+
+    def byte_size(self):
+        return self.delta.byte_size()
+
+    def compress(self):
+        self.delta.compress()
+
+    def drop(self):
+        # Frees the edit's undo data, leaving it applied for good: obsolete
+        # commands are deleted by the stack rather than undone
+        self.delta = PixelDelta(array("H"), b"", b"")
+        self.setObsolete(True)
+
+    def validate(self):
+        if self.delta.is_empty():
+            return Validator(False, "")
+
+        return Validator(True, "")
+
+class cmd_replace_color(QUndoCommand):
+
+    def __init__(self, data_source, old_color_index, new_color_index, selection, region, parent=None):
+        super().__init__("replace color", parent)
+        self.data_source = data_source
+        self.old_color_index = old_color_index
+        self.new_color_index = new_color_index
+        scale_factor = 8
+        # A null region replaces the color across the whole sheet
+        if region.isNull():
+            self.selection = data_source.get_image().rect()
+        else:
+            self.selection = QRect(
+                selection.x() * scale_factor + region.x(),
+                selection.y() * scale_factor + region.y(),
+                region.width(),
+                region.height()
+            )
+        self.delta = data_source.get_color_delta(old_color_index, new_color_index, self.selection)
 
     def redo(self):
-        self.data_source.set_pixels(self.new_pixels, self.selection)
+        self.data_source.replace_color(self.old_color_index, self.new_color_index, self.selection)
 
     def undo(self):
-        self.data_source.set_pixels(self.original_pixels, self.selection)
+        self.data_source.set_pixel_runs(self.delta.get_positions(), self.delta.get_old_pixels())
+
+    def byte_size(self):
+        return self.delta.byte_size()
+
+    def compress(self):
+        self.delta.compress()
+
+    def drop(self):
+        # Frees the edit's undo data, leaving it applied for good: obsolete
+        # commands are deleted by the stack rather than undone
+        self.delta = PixelDelta(array("H"), b"", b"")
+        self.setObsolete(True)
 
     def validate(self):
+        if self.old_color_index == self.new_color_index:
+            return Validator(False, "")
+        if self.delta.is_empty():
+            return Validator(False, "")
+
         return Validator(True, "")
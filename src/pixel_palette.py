@@ -37,6 +37,10 @@ class PixelPalette(QWidget, Ui_pixel_palette):
     def set_color_table(self, color_table):
         self.pixel_palette_grid.set_color_table(color_table)
 
+    @pyqtSlot(QRect)
+    def update_pixels(self, pixel_rect):
+        self.pixel_palette_grid.update_pixels(pixel_rect)
+
     def get_selection(self):
         return self.pixel_palette_grid.get_selection()
 
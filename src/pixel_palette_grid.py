@@ -3,6 +3,7 @@ from PyQt5.QtCore import (
     pyqtSignal,
     pyqtSlot,
     QRect,
+    QRectF,
     QPoint
 ) 
 from PyQt5.QtWidgets import (
@@ -57,6 +58,18 @@ class PixelPaletteGrid(QWidget):
         self.palette.setColor(index, color.rgb())
         self.update()
 
+    @pyqtSlot(QRect)
+    def update_pixels(self, pixel_rect):
+        palette_x = (self.width() - self.scale_factor * self.palette.width()) / 2
+        self.update(
+            QRectF(
+                palette_x + pixel_rect.x() * self.scale_factor,
+                pixel_rect.y() * self.scale_factor,
+                pixel_rect.width() * self.scale_factor,
+                pixel_rect.height() * self.scale_factor
+            ).toAlignedRect().adjusted(-1, -1, 1, 1)
+        )
+
     def set_asset_names(self, names):
         self.names = names
 
@@ -79,10 +92,17 @@ class PixelPaletteGrid(QWidget):
         palette_x = round((self.width() - self.scale_factor * self.palette.width()) / 2)
         palette_y = 0
 
-        # Scale and draw the image
+        # Scale and draw the image, limited by Qt to the region being repainted
         if not self.palette.isNull():
-            scaled_image = self.palette.scaled(self.width(), self.height(), Qt.KeepAspectRatio)
-            painter.drawImage(palette_x, palette_y, scaled_image)
+            painter.drawImage(
+                QRectF(
+                    palette_x,
+                    palette_y,
+                    self.scale_factor * self.palette.width(),
+                    self.scale_factor * self.palette.height()
+                ),
+                self.palette
+            )
 
         for row in range(0, self.palette.height(), self.grid_cell_size):
             y_grid = round(palette_y + row * self.scale_factor)
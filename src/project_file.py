@@ -0,0 +1,407 @@
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from pixel_data import PixelData
+from tile_map_data import TileMap
+
+# Binary project container: a header, a table of (tag, offset, length)
+# sections, then each section's packed contents, 8 byte aligned
+binary_extension = ".jrb"
+binary_magic = b"JIDEPRJ\x00"
+binary_version = 1
+
+file_header = struct.Struct("<8sHH")
+section_entry = struct.Struct("<4sQQ")
+sheet_header = struct.Struct("<HHI")
+count_header = struct.Struct("<H")
+name_header = struct.Struct("<H")
+tile_map_header = struct.Struct("<HH")
+
+# Section tags keyed by project section
+pixel_sections = {"sprites": b"SPRT", "tiles": b"TILE"}
+palette_sections = {"sprite_color_palettes": b"SPAL", "tile_color_palettes": b"TPAL"}
+tile_map_section = b"TMAP"
+section_tags = {**pixel_sections, **palette_sections, "tile_maps": tile_map_section}
+section_keys = list(section_tags)
+
+# JSON project scanning
+json_decoder = json.JSONDecoder()
+json_whitespace = re.compile(r"[ \t\n\r]*")
+
+# Tile map contents are nested arrays of numbers, so they can be located
+# without being decoded
+tile_map_contents = re.compile(r"\[[\[\]\d,\s]*\]")
+
+def is_binary_project(file_name):
+    return file_name.endswith(binary_extension)
+
+def pack_name(name):
+    encoded_name = name.encode()
+    return name_header.pack(len(encoded_name)) + encoded_name
+
+def unpack_name(buffer, offset, end):
+    (length,), offset = unpack_header(name_header, buffer, offset, end)
+    name_bytes, offset = unpack_bytes(buffer, offset, length, end)
+    return name_bytes.decode(), offset
+
+def unpack_header(header, buffer, offset, end):
+    # Reads within a section are bounded by its length in the section
+    # table, so truncated or inconsistent data is rejected
+    if offset + header.size > end:
+        raise ValueError("Section data is truncated")
+    return header.unpack_from(buffer, offset), offset + header.size
+
+def unpack_bytes(buffer, offset, length, end):
+    if offset + length > end:
+        raise ValueError("Section data is truncated")
+    return bytes(buffer[offset:offset + length]), offset + length
+
+def json_to_sections(project_data):
+    # Sections hold sheets as (pixels, width, height, names), palettes as
+    # in JSON and tile maps as (name, width, height, words)
+    sections = {key: PixelData.parse_pixel_data(project_data[key]) for key in pixel_sections}
+    for key in palette_sections:
+        sections[key] = [
+            {"name": palette["name"], "contents": list(palette["contents"])}
+            for palette in project_data[key]
+        ]
+    sections["tile_maps"] = [
+        (
+            tile_map["name"],
+            tile_map["width"],
+            tile_map["height"],
+            TileMap.parse_tile_map_data(tile_map["contents"])
+        )
+        for tile_map in project_data["tile_maps"]
+    ]
+
+    return sections
+
+def skip_json_whitespace(text, index):
+    return json_whitespace.match(text, index).end()
+
+def expect_json_token(text, index, token):
+    index = skip_json_whitespace(text, index)
+    if not text.startswith(token, index):
+        raise ValueError("Expecting '{}' at {}".format(token, index))
+    return index + len(token)
+
+def decode_json_value(text, index):
+    return json_decoder.raw_decode(text, skip_json_whitespace(text, index))
+
+def scan_json_container(text, index, open_token, close_token, scan_item):
+    # Walks a JSON array or object, with scan_item consuming each item
+    # and returning the index past it
+    index = skip_json_whitespace(text, expect_json_token(text, index, open_token))
+    if text.startswith(close_token, index):
+        return index + 1
+
+    while True:
+        index = skip_json_whitespace(text, scan_item(skip_json_whitespace(text, index)))
+        if text.startswith(close_token, index):
+            return index + 1
+        index = expect_json_token(text, index, ",")
+
+def scan_json_object(text, index, scan_value):
+    def scan_member(index):
+        key, index = json_decoder.raw_decode(text, index)
+        return scan_value(key, expect_json_token(text, index, ":"))
+
+    return scan_json_container(text, index, "{", "}", scan_member)
+
+def read_json_project(text):
+    # Decodes everything but tile map contents, which are only located
+    # and left to be decoded once their tile map is first used
+    project_data = {}
+    tile_maps = []
+
+    def scan_section(key, index):
+        if key == "tile_maps":
+            return scan_json_container(text, index, "[", "]", scan_tile_map)
+        project_data[key], index = decode_json_value(text, index)
+        return index
+
+    def scan_tile_map(index):
+        tile_map = {}
+
+        def scan_tile_map_value(key, index):
+            if key == "contents":
+                contents = tile_map_contents.match(text, skip_json_whitespace(text, index))
+                if contents is None or contents.group().count("[") != contents.group().count("]"):
+                    raise ValueError("Malformed tile map contents at {}".format(index))
+                tile_map[key] = contents.group()
+                return contents.end()
+            tile_map[key], index = decode_json_value(text, index)
+            return index
+
+        index = scan_json_object(text, index, scan_tile_map_value)
+        if tile_map["contents"].count("[") - 1 != tile_map["width"] * tile_map["height"]:
+            raise ValueError("Tile map {} doesn't match its dimensions".format(tile_map["name"]))
+        tile_maps.append(tile_map)
+        return index
+
+    scan_json_object(text, 0, scan_section)
+    project_data["tile_maps"] = []
+    sections = json_to_sections(project_data)
+    sections["tile_maps"] = [
+        (
+            tile_map["name"],
+            tile_map["width"],
+            tile_map["height"],
+            TileMapSource(tile_map["contents"], False, tile_map["width"] * tile_map["height"])
+        )
+        for tile_map in tile_maps
+    ]
+
+    return sections
+
+def load_json_tile_map(contents, size):
+    # Contents are only located when the project is read, so their shape and
+    # values are checked here, as they're decoded
+    tile_map_data = json.loads(contents)
+    if len(tile_map_data) != size or any(len(tile) != 2 for tile in tile_map_data):
+        raise ValueError("Tile map contents don't match its dimensions")
+    return TileMap.parse_tile_map_data(tile_map_data)
+
+class TileMapSource:
+
+    # A tile map's contents as read from a project file, binary words or
+    # JSON text, decoded when the tile map is first used and otherwise
+    # written back as they were
+    def __init__(self, contents, binary, size):
+        self.contents = contents
+        self.binary = binary
+        self.size = size
+
+    def __call__(self):
+        if self.binary:
+            return unpack_tile_map_words(self.contents)
+        return load_json_tile_map(self.contents, self.size)
+
+def tile_map_words(words):
+    # Decodes a tile map source where its contents are needed in another form
+    return words() if isinstance(words, TileMapSource) else words
+
+def tile_map_word_bytes(words):
+    if isinstance(words, TileMapSource) and words.binary:
+        return words.contents
+    return TileMap.to_little_endian(tile_map_words(words))
+
+def iter_section_items(key, value):
+    # A project section's JSON items, produced lazily in file order
+    if key in pixel_sections:
+        return PixelData.iter_json_assets(*value)
+    if key in palette_sections:
+        return (
+            {"name": palette["name"], "contents": list(palette["contents"])}
+            for palette in value
+        )
+    return (tile_map_to_json(tile_map) for tile_map in value)
+
+def tile_map_to_json(tile_map):
+    name, width, height, words = tile_map
+    return {
+        "name": name,
+        "width": width,
+        "height": height,
+        "contents": TileMap.to_json_contents(tile_map_words(words))
+    }
+
+def iter_json_sections(sections):
+    for key in section_keys:
+        yield key, iter_section_items(key, sections[key])
+
+def sections_to_json(sections):
+    return {key: list(items) for key, items in iter_json_sections(sections)}
+
+def write_json_project(project_file, sections):
+    # Streams the same text json.dump would write for the whole project,
+    # one asset, palette or tile map at a time
+    project_file.write("{")
+    for section_index, (key, items) in enumerate(iter_json_sections(sections)):
+        project_file.write((", " if section_index else "") + json.dumps(key) + ": [")
+        for item_index, item in enumerate(items):
+            project_file.write((", " if item_index else "") + json.dumps(item))
+        project_file.write("]")
+    project_file.write("}")
+
+def pack_section(key, value):
+    if key in pixel_sections:
+        pixels, width, height, names = value
+        return sheet_header.pack(width, height, len(names)) + bytes(pixels) + b"".join(
+            pack_name(name) for name in names
+        )
+    if key in palette_sections:
+        return count_header.pack(len(value)) + b"".join(
+            pack_name(palette["name"]) +
+            count_header.pack(len(palette["contents"])) +
+            bytes(palette["contents"])
+            for palette in value
+        )
+    return join_tile_maps([encode_tile_map(tile_map, True) for tile_map in value], True)
+
+def encode_section(key, value, binary):
+    # A section as it appears in a project file: its payload in the binary
+    # container, or its "key": [...] member of the JSON object
+    if binary:
+        return pack_section(key, value)
+    if key == "tile_maps":
+        return join_tile_maps([encode_tile_map(tile_map, False) for tile_map in value], False)
+    return json.dumps(key) + ": [" + ", ".join(
+        json.dumps(item) for item in iter_section_items(key, value)
+    ) + "]"
+
+def encode_tile_map(tile_map, binary):
+    name, width, height, words = tile_map
+    if binary:
+        return (
+            pack_name(name) +
+            tile_map_header.pack(width, height) +
+            tile_map_word_bytes(words)
+        )
+    if isinstance(words, TileMapSource) and not words.binary:
+        header = json.dumps({"name": name, "width": width, "height": height})
+        return header[:-1] + ", " + json.dumps("contents") + ": " + words.contents + "}"
+    return json.dumps(tile_map_to_json(tile_map))
+
+def join_tile_maps(encoded_tile_maps, binary):
+    if binary:
+        return count_header.pack(len(encoded_tile_maps)) + b"".join(encoded_tile_maps)
+    return json.dumps("tile_maps") + ": [" + ", ".join(encoded_tile_maps) + "]"
+
+def pack_sections(sections):
+    return pack_container([
+        (section_tags[key], pack_section(key, sections[key])) for key in section_keys
+    ])
+
+def pack_container(packed_sections):
+    table_size = file_header.size + section_entry.size * len(packed_sections)
+    offset = table_size + (-table_size % 8)
+    table = [file_header.pack(binary_magic, binary_version, len(packed_sections))]
+    contents = [bytes(offset - table_size)]
+    for tag, payload in packed_sections:
+        table.append(section_entry.pack(tag, offset, len(payload)))
+        padding = -len(payload) % 8
+        contents.append(payload + bytes(padding))
+        offset += len(payload) + padding
+
+    return b"".join(table + contents)
+
+def unpack_tile_map_words(buffer):
+    words = array("H")
+    words.frombytes(buffer)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+def unpack_sections(buffer, lazy_tile_maps=False):
+    magic, version, section_count = file_header.unpack_from(buffer)
+    if magic != binary_magic or version != binary_version:
+        raise ValueError("Not a binary project file")
+
+    table = {}
+    for index in range(section_count):
+        tag, offset, length = section_entry.unpack_from(
+            buffer,
+            file_header.size + index * section_entry.size
+        )
+        if offset + length > len(buffer):
+            raise ValueError("Section extends past the end of the file")
+        table[tag] = (offset, offset + length)
+
+    sections = {}
+    for key, tag in pixel_sections.items():
+        offset, end = table[tag]
+        (width, height, asset_count), offset = unpack_header(sheet_header, buffer, offset, end)
+        pixels, offset = unpack_bytes(buffer, offset, width * height, end)
+        names = []
+        for _ in range(asset_count):
+            name, offset = unpack_name(buffer, offset, end)
+            names.append(name)
+        check_section_end(offset, end)
+        sections[key] = (pixels, width, height, names)
+
+    for key, tag in palette_sections.items():
+        offset, end = table[tag]
+        (palette_count,), offset = unpack_header(count_header, buffer, offset, end)
+        palettes = []
+        for _ in range(palette_count):
+            name, offset = unpack_name(buffer, offset, end)
+            (color_count,), offset = unpack_header(count_header, buffer, offset, end)
+            contents, offset = unpack_bytes(buffer, offset, color_count, end)
+            palettes.append({"name": name, "contents": list(contents)})
+        check_section_end(offset, end)
+        sections[key] = palettes
+
+    offset, end = table[tile_map_section]
+    (tile_map_count,), offset = unpack_header(count_header, buffer, offset, end)
+    tile_maps = []
+    for _ in range(tile_map_count):
+        name, offset = unpack_name(buffer, offset, end)
+        (width, height), offset = unpack_header(tile_map_header, buffer, offset, end)
+        word_bytes, offset = unpack_bytes(buffer, offset, width * height * 2, end)
+        if lazy_tile_maps:
+            tile_maps.append((name, width, height, TileMapSource(word_bytes, True, width * height)))
+        else:
+            tile_maps.append((name, width, height, unpack_tile_map_words(word_bytes)))
+    check_section_end(offset, end)
+    sections["tile_maps"] = tile_maps
+
+    return sections
+
+def check_section_end(offset, end):
+    if offset != end:
+        raise ValueError("Section length doesn't match its contents")
+
+def read_binary_project(file_name):
+    # Tile maps are copied out of the map but decoded on first use
+    with open(file_name, "rb") as project_file:
+        with mmap.mmap(project_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return unpack_sections(buffer, lazy_tile_maps=True)
+
+def write_binary_project(file_name, sections):
+    with open(file_name, "wb") as project_file:
+        project_file.write(pack_sections(sections))
+
+def write_project_file(file_name, sections):
+    binary = is_binary_project(file_name)
+    write_encoded_project(
+        file_name,
+        {key: encode_section(key, sections[key], binary) for key in section_keys}
+    )
+
+def write_encoded_project(file_name, encoded_sections):
+    # Written beside the target and renamed over it, so an interrupted
+    # save never leaves a truncated project behind
+    temp_file_name = file_name + ".tmp"
+    try:
+        if is_binary_project(file_name):
+            with open(temp_file_name, "wb") as project_file:
+                project_file.write(pack_container([
+                    (section_tags[key], encoded_sections[key]) for key in section_keys
+                ]))
+                project_file.flush()
+                os.fsync(project_file.fileno())
+        else:
+            with open(temp_file_name, "w") as project_file:
+                project_file.write("{")
+                for index, key in enumerate(section_keys):
+                    project_file.write((", " if index else "") + encoded_sections[key])
+                project_file.write("}")
+                project_file.flush()
+                os.fsync(project_file.fileno())
+        os.replace(temp_file_name, file_name)
+    except Exception:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+def json_to_binary(project_data):
+    return pack_sections(json_to_sections(project_data))
+
+def binary_to_json(buffer):
+    return sections_to_json(unpack_sections(buffer))
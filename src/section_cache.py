@@ -0,0 +1,131 @@
+from project_file import (
+    pixel_sections,
+    palette_sections,
+    encode_section,
+    encode_tile_map,
+    join_tile_maps
+)
+
+class SectionCache:
+
+    # Keeps each section's encoded form from the last save along with the
+    # model revision it was encoded from, so a save only re-encodes the
+    # sections and tile maps edited since
+    def __init__(
+            self,
+            sprite_pixel_data,
+            tile_pixel_data,
+            sprite_color_data,
+            tile_color_data,
+            tile_map_data
+        ):
+        self.pixel_data = {"sprites": sprite_pixel_data, "tiles": tile_pixel_data}
+        self.color_data = {
+            "sprite_color_palettes": sprite_color_data,
+            "tile_color_palettes": tile_color_data
+        }
+        self.tile_map_data = tile_map_data
+        self.revisions = dict.fromkeys(list(pixel_sections) + list(palette_sections), 0)
+        self.fragments = {}
+        self.tile_map_fragments = {}
+
+        for key, pixel_data in self.pixel_data.items():
+            pixel_data.pixels_updated.connect(lambda *_, key=key: self.touch(key))
+            pixel_data.data_updated.connect(lambda key=key: self.touch(key))
+            pixel_data.name_updated.connect(lambda *_, key=key: self.touch(key))
+        for key, color_data in self.color_data.items():
+            for signal in (
+                color_data.color_palette_added,
+                color_data.color_palette_removed,
+                color_data.color_palette_renamed,
+                color_data.color_updated
+            ):
+                signal.connect(lambda *_, key=key: self.touch(key))
+
+    def touch(self, key):
+        self.revisions[key] += 1
+
+    def get_section(self, key):
+        if key in self.pixel_data:
+            pixel_data = self.pixel_data[key]
+            image = pixel_data.get_image()
+            return (
+                pixel_data.get_packed_pixels(),
+                image.width(),
+                image.height(),
+                list(pixel_data.get_names())
+            )
+        return self.color_data[key].to_json()
+
+    @staticmethod
+    def get_tile_map_section(tile_map):
+        # Tile maps yet to be decoded, or which failed to, carry their source
+        return (
+            tile_map.get_name(),
+            tile_map.get_width(),
+            tile_map.get_height(),
+            tile_map.get_data() if tile_map.is_loaded() else tile_map.get_source()
+        )
+
+    def get_sections(self):
+        sections = {key: self.get_section(key) for key in self.revisions}
+        sections["tile_maps"] = [
+            self.get_tile_map_section(tile_map) for tile_map in self.tile_map_data.get_tile_maps()
+        ]
+
+        return sections
+
+    def snapshot(self, binary):
+        # Runs on the GUI thread: sections unchanged since they were last
+        # encoded carry their fragment, the rest a copy of the model data
+        sections = {}
+        for key, revision in self.revisions.items():
+            revision_fragment = self.fragments.get((binary, key))
+            if revision_fragment is not None and revision_fragment[0] == revision:
+                sections[key] = (revision, revision_fragment[1], None)
+            else:
+                sections[key] = (revision, None, self.get_section(key))
+
+        tile_maps = self.tile_map_data.get_tile_maps()
+        tile_map_ids = {id(tile_map) for tile_map in tile_maps}
+        self.tile_map_fragments = {
+            cache_key: revision_fragment
+            for cache_key, revision_fragment in self.tile_map_fragments.items()
+            if id(cache_key[1]) in tile_map_ids
+        }
+        tile_map_sections = []
+        for tile_map in tile_maps:
+            revision = tile_map.get_revision()
+            revision_fragment = self.tile_map_fragments.get((binary, tile_map))
+            if revision_fragment is not None and revision_fragment[0] == revision:
+                tile_map_sections.append((tile_map, revision, revision_fragment[1], None))
+            else:
+                tile_map_sections.append((
+                    tile_map,
+                    revision,
+                    None,
+                    self.get_tile_map_section(tile_map)
+                ))
+
+        return binary, sections, tile_map_sections
+
+    def encode(self, snapshot):
+        # Safe to run on the save thread, as fragments are stored against
+        # the revision they were snapshotted at
+        binary, sections, tile_map_sections = snapshot
+        encoded_sections = {}
+        for key, (revision, fragment, value) in sections.items():
+            if fragment is None:
+                fragment = encode_section(key, value, binary)
+                self.fragments[(binary, key)] = (revision, fragment)
+            encoded_sections[key] = fragment
+
+        encoded_tile_maps = []
+        for tile_map, revision, fragment, value in tile_map_sections:
+            if fragment is None:
+                fragment = encode_tile_map(value, binary)
+                self.tile_map_fragments[(binary, tile_map)] = (revision, fragment)
+            encoded_tile_maps.append(fragment)
+        encoded_sections["tile_maps"] = join_tile_maps(encoded_tile_maps, binary)
+
+        return encoded_sections
@@ -0,0 +1,89 @@
+from PyQt5.QtCore import (
+    QObject,
+    pyqtSignal,
+    pyqtSlot,
+    QRect
+)
+from PyQt5.QtGui import (
+    QColor,
+    QPixmap
+)
+
+class TileAtlas(QObject):
+
+    tiles_updated = pyqtSignal(list)
+    color_updated = pyqtSignal(int, int)
+    atlas_reset = pyqtSignal()
+
+    def __init__(self, color_data, pixel_data, parent=None):
+        super().__init__(parent)
+        self.color_data = color_data
+        self.pixel_data = pixel_data
+        self.color_tables = {}
+        self.tile_colors = {}
+        self.tiles = {}
+
+    def get_tile(self, tile_palette_index, color_palette_index):
+        key = (tile_palette_index, color_palette_index)
+        if key not in self.tiles:
+            if tile_palette_index < self.pixel_data.get_asset_count():
+                tile_image = self.pixel_data.get_asset_view(tile_palette_index)
+            else:
+                tile_image = self.pixel_data.get_asset(tile_palette_index)
+            tile_image.setColorTable(self.get_color_table(color_palette_index))
+            self.tiles[key] = QPixmap.fromImage(tile_image)
+
+        return self.tiles[key]
+
+    def get_color_table(self, color_palette_index):
+        if color_palette_index not in self.color_tables:
+            color_palette_name = self.color_data.get_color_palette_name(color_palette_index)
+            self.color_tables[color_palette_index] = [
+                color.rgb() for color in self.color_data.get_color_palette(color_palette_name)
+            ]
+
+        return self.color_tables[color_palette_index]
+
+    def get_tile_colors(self, tile_palette_index):
+        if tile_palette_index not in self.tile_colors:
+            self.tile_colors[tile_palette_index] = frozenset(
+                self.pixel_data.get_asset_pixels(tile_palette_index) or b"\x00"
+            )
+
+        return self.tile_colors[tile_palette_index]
+
+    @pyqtSlot(str, QColor, int)
+    def set_color(self, color_palette_name, color, index):
+        color_palette_index = list(self.color_data.get_color_data()).index(color_palette_name)
+        color_table = self.get_color_table(color_palette_index)
+        if color_table[index] == color.rgb():
+            return
+        color_table[index] = color.rgb()
+
+        # Only tiles which actually use the recolored index need rerendering
+        for key in [
+            key for key in self.tiles
+            if key[1] == color_palette_index and index in self.get_tile_colors(key[0])
+        ]:
+            del self.tiles[key]
+
+        self.color_updated.emit(color_palette_index, index)
+
+    @pyqtSlot(QRect)
+    def update_pixels(self, pixel_rect):
+        tile_palette_indices = self.pixel_data.get_asset_indices(pixel_rect)
+        updated = set(tile_palette_indices)
+
+        for key in [key for key in self.tiles if key[0] in updated]:
+            del self.tiles[key]
+        for tile_palette_index in tile_palette_indices:
+            self.tile_colors.pop(tile_palette_index, None)
+
+        self.tiles_updated.emit(tile_palette_indices)
+
+    @pyqtSlot()
+    def reset(self):
+        self.color_tables.clear()
+        self.tile_colors.clear()
+        self.tiles.clear()
+        self.atlas_reset.emit()
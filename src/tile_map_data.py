@@ -4,7 +4,12 @@ from PyQt5.QtCore import (
     pyqtSlot
 )
 from PyQt5.QtWidgets import QUndoCommand
-from undo_stack import Validator
+from undo_stack import (
+    Validator,
+    CommandId
+)
+import sys
+from array import array
 from collections import namedtuple
 
 Tile = namedtuple('Tile', ['color_palette_index', 'tile_palette_index'])
@@ -14,21 +19,21 @@ class TileMapData(QObject):
     tile_map_added = pyqtSignal(str)
     tile_map_removed = pyqtSignal(str)
     tile_map_renamed = pyqtSignal(str, str)
+    tile_map_load_failed = pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
         self.tile_maps = []
 
-    def add_tile_map(self, tile_map_name, tile_map_width, tile_map_height, tile_map_data):
-        tile_map = TileMap(tile_map_name, tile_map_width, tile_map_height)
-
-        for y in range(tile_map_height):
-            for x in range(tile_map_width):
-                tile_data = tile_map_data[y * tile_map_width + x]
-                tile_map.set_tile(x, y, tile_data[0], tile_data[1])
+    def add_tile_map(self, tile_map_name, tile_map_width, tile_map_height, tile_map_data=None):
+        self.insert_tile_map(
+            TileMap(tile_map_name, tile_map_width, tile_map_height, tile_map_data)
+        )
 
+    def insert_tile_map(self, tile_map):
+        tile_map.load_failed = self.tile_map_load_failed.emit
         self.tile_maps.append(tile_map)
-        self.tile_map_added.emit(tile_map_name)
+        self.tile_map_added.emit(tile_map.get_name())
 
     def remove_tile_map(self, tile_map_name):
         removed_tile_map = None
@@ -61,24 +66,171 @@ class TileMapData(QObject):
                 return tile
 
     def to_json(self):
-        return [tile_map.to_json() for tile_map in self.tile_maps]
+        return list(self.iter_json())
+
+    def iter_json(self):
+        for tile_map in self.tile_maps:
+            yield tile_map.to_json()
 
 class TileMap:
-    def __init__(self, name, width, height):
+
+    chunk_size = 32
+
+    # Blank chunks share this chunk until a non-blank tile is written
+    empty_chunk = array("H", [0]) * (chunk_size * chunk_size)
+
+    # Each cell is a JCAP tile map word: color palette index in the high
+    # byte, tile palette index in the low byte
+    def __init__(self, name, width, height, data=None):
         self.name = name
         self.width = width
         self.height = height
-        self.data = [[Tile(0, 0) for _ in range(width)] for _ in range(height)]
+        self.chunks = {}
+        # Distinct tile words in each stored chunk, and the chunks holding
+        # each tile word, so redraws for a changed tile skip other chunks
+        self.chunk_tile_words = {}
+        self.tile_word_chunks = {}
+        self.revision = 0
+        self.loader = None
+        self.failed = False
+        self.load_failed = None
+
+        # Data may be a callable producing the words, deferring their
+        # decoding until the tile map is first read or drawn
+        if callable(data):
+            self.loader = data
+        elif data is not None:
+            self.write_region(0, 0, width, height, data)
+
+    def load(self):
+        if self.loader is None or self.failed:
+            return
+
+        # Loading happens wherever the tile map is first used, even while
+        # painting, so malformed data is only reported. The tile map is left
+        # blank and can't be edited, but keeps its loader so the original
+        # data is saved back unchanged
+        try:
+            self.write_region(0, 0, self.width, self.height, self.loader())
+            self.loader = None
+        except (TypeError, ValueError):
+            self.failed = True
+            self.chunks = {}
+            self.chunk_tile_words = {}
+            self.tile_word_chunks = {}
+            if self.load_failed is not None:
+                self.load_failed(self.name)
+
+    def is_loaded(self):
+        return self.loader is None
+
+    def is_failed(self):
+        return self.failed
+
+    def get_source(self):
+        # What the tile map was created from, until it's been decoded
+        return self.loader
+
+    @staticmethod
+    def pack_tile(color_palette_index, tile_palette_index):
+        # Either index spilling out of its byte would corrupt the other
+        if not (0 <= color_palette_index <= 0xFF and 0 <= tile_palette_index <= 0xFF):
+            raise ValueError("Palette index out of range for a tile map word")
+        return (color_palette_index << 8) | tile_palette_index
+
+    @staticmethod
+    def unpack_tile(tile_word):
+        return Tile(tile_word >> 8, tile_word & 0xFF)
 
     def get_tile(self, x, y):
-        return self.data[y][x]
+        self.load()
+        chunk_x, local_x = divmod(x, TileMap.chunk_size)
+        chunk_y, local_y = divmod(y, TileMap.chunk_size)
+        chunk = self.chunks.get((chunk_x, chunk_y), TileMap.empty_chunk)
+        return TileMap.unpack_tile(chunk[local_y * TileMap.chunk_size + local_x])
 
     def set_tile(self, x, y, color_palette_index, tile_palette_index):
-        self.data[y][x] = Tile(color_palette_index, tile_palette_index)
+        self.set_region(x, y, 1, 1, [TileMap.pack_tile(color_palette_index, tile_palette_index)])
+
+    def get_chunk_grid_size(self):
+        return (
+            -(-self.width // TileMap.chunk_size),
+            -(-self.height // TileMap.chunk_size)
+        )
+
+    def get_chunk(self, chunk_x, chunk_y):
+        self.load()
+        return self.chunks.get((chunk_x, chunk_y))
+
+    def get_tile_word_chunks(self):
+        self.load()
+        return self.tile_word_chunks
+
+    def get_region(self, x, y, width, height):
+        self.load()
+        region = array("H")
+        for row in range(y, y + height):
+            chunk_y, local_y = divmod(row, TileMap.chunk_size)
+            col = x
+            while col < x + width:
+                chunk_x, local_x = divmod(col, TileMap.chunk_size)
+                span = min(TileMap.chunk_size - local_x, x + width - col)
+                chunk = self.chunks.get((chunk_x, chunk_y), TileMap.empty_chunk)
+                offset = local_y * TileMap.chunk_size + local_x
+                region.extend(chunk[offset:offset + span])
+                col += span
+
+        return region
+
+    def set_region(self, x, y, width, height, region):
+        self.load()
+        if self.failed:
+            raise ValueError("Tile map {} failed to load and can't be edited".format(self.name))
+        self.revision += 1
+        self.write_region(x, y, width, height, region)
+
+    def write_region(self, x, y, width, height, region):
+        region = array("H", region)
+        written_chunks = set()
+        for row in range(height):
+            chunk_y, local_y = divmod(y + row, TileMap.chunk_size)
+            col = x
+            while col < x + width:
+                chunk_x, local_x = divmod(col, TileMap.chunk_size)
+                span = min(TileMap.chunk_size - local_x, x + width - col)
+                words = region[row * width + col - x:row * width + col - x + span]
+                col += span
+
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is None:
+                    if not any(words):
+                        continue
+                    chunk = self.chunks[(chunk_x, chunk_y)] = array("H", TileMap.empty_chunk)
+                offset = local_y * TileMap.chunk_size + local_x
+                chunk[offset:offset + span] = words
+                written_chunks.add((chunk_x, chunk_y))
+
+        for chunk_position in written_chunks:
+            self.index_chunk(chunk_position)
+
+    def index_chunk(self, chunk_position):
+        old_tile_words = self.chunk_tile_words.get(chunk_position, set())
+        new_tile_words = self.chunk_tile_words[chunk_position] = set(self.chunks[chunk_position])
+        for tile_word in old_tile_words - new_tile_words:
+            chunk_positions = self.tile_word_chunks[tile_word]
+            chunk_positions.discard(chunk_position)
+            if not chunk_positions:
+                del self.tile_word_chunks[tile_word]
+        for tile_word in new_tile_words - old_tile_words:
+            self.tile_word_chunks.setdefault(tile_word, set()).add(chunk_position)
 
     def set_name(self, tile_map_name):
+        self.revision += 1
         self.name = tile_map_name
 
+    def get_revision(self):
+        return self.revision
+
     def get_name(self):
         return self.name
 
@@ -89,18 +241,45 @@ class TileMap:
         return self.height
 
     def get_data(self):
-        return [tile for row in self.data for tile in row]
+        return self.get_region(0, 0, self.width, self.height)
 
     def to_json(self):
         return {
             "name": self.name,
             "width": self.width,
             "height": self.height,
-            "contents": [
-                [tile.color_palette_index, tile.tile_palette_index] for row in self.data for tile in row
-            ]
+            "contents": TileMap.to_json_contents(self.get_data())
         }
 
+    @staticmethod
+    def to_json_contents(tile_words):
+        # Split the little endian words into their color and tile bytes
+        # rather than shifting each word
+        word_bytes = TileMap.to_little_endian(tile_words)
+        return list(map(list, zip(word_bytes[1::2], word_bytes[0::2])))
+
+    @staticmethod
+    def parse_tile_map_data(data):
+        tile_words = array("H")
+        if not data:
+            return tile_words
+
+        color_palette_indices, tile_palette_indices = zip(*data)
+        word_bytes = bytearray(len(data) * tile_words.itemsize)
+        word_bytes[0::2] = bytes(tile_palette_indices)
+        word_bytes[1::2] = bytes(color_palette_indices)
+        tile_words.frombytes(word_bytes)
+        if sys.byteorder == "big":
+            tile_words.byteswap()
+        return tile_words
+
+    @staticmethod
+    def to_little_endian(tile_words):
+        if sys.byteorder == "big":
+            tile_words = array("H", tile_words)
+            tile_words.byteswap()
+        return tile_words.tobytes()
+
 class cmd_add_tile_map(QUndoCommand):
 
     def __init__(
@@ -109,7 +288,7 @@ class cmd_add_tile_map(QUndoCommand):
             tile_map_name,
             tile_map_width=40,
             tile_map_height=30,
-            tile_map_data=[[0, 0] for _ in range(40 * 30)],
+            tile_map_data=None,
             parent=None
         ):
         super().__init__("add tile map", parent)
@@ -150,12 +329,7 @@ class cmd_remove_tile_map(QUndoCommand):
         self.removed_tile_map = self.data_source.remove_tile_map(self.tile_map_name)
 
     def undo(self):
-        self.data_source.add_tile_map(
-            self.removed_tile_map.get_name(),
-            self.removed_tile_map.get_width(),
-            self.removed_tile_map.get_height(),
-            self.removed_tile_map.get_data()
-        )
+        self.data_source.insert_tile_map(self.removed_tile_map)
     def validate(self):
         if len(self.data_source.get_tile_maps()) == 1:
             return Validator(False, "At least one tile map is required")
@@ -176,6 +350,17 @@ class cmd_rename_tile_map(QUndoCommand):
     def undo(self):
         self.data_source.rename_tile_map(self.new_tile_map_name, self.old_tile_map_name)
 
+    def id(self):
+        return CommandId.RENAME_TILE_MAP
+
+    def mergeWith(self, other):
+        if other.data_source is not self.data_source or other.old_tile_map_name != self.new_tile_map_name:
+            return False
+
+        self.new_tile_map_name = other.new_tile_map_name
+        self.setObsolete(self.new_tile_map_name == self.old_tile_map_name)
+        return True
+
     def validate(self):
         if self.old_tile_map_name == self.new_tile_map_name:
             return Validator(False, "")
@@ -20,4 +20,8 @@ class BaseTool(QObject):
 
     def mouseMoveEvent(self, event: QMouseEvent) -> None: ...
 
+    def mouseMoveEvents(self, events: list) -> None:
+        # Moves coalesced over a frame; most tools only need the latest
+        self.mouseMoveEvent(events[-1])
+
     def mouseReleaseEvent(self, event: QMouseEvent) -> None: ...
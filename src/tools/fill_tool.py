@@ -1,17 +1,24 @@
+import re
 from PyQt5.QtGui import QImage
 from PyQt5.QtCore import (
+    Qt,
     pyqtSignal,
-    QPoint
+    QPoint,
+    QRect
 )
 from tools.base_tool import BaseTool
+from tools.stroke_buffer import StrokeBuffer
+from pixel_data import PixelData
 
 class FillTool(BaseTool):
 
-    scene_edited = pyqtSignal(QImage)
+    scene_edited = pyqtSignal(QImage, QPoint)
+    color_replaced = pyqtSignal(int, int, QRect)
 
     def __init__(self, view):
         super().__init__(view)
         self.image = None
+        self.stroke = None
         self.color = None
         self.color_index = None
 
@@ -27,52 +34,72 @@ class FillTool(BaseTool):
         if not (x_limit <= scene_pos.x() < width_limit and y_limit <= scene_pos.y() < height_limit):
             return
 
-        # TODO: Check if there will be no change because target color = starting pixel color
-
         self.image = self.view.scene().get_image(cropped=True)
-        self.flood_fill(
-            QPoint(
-                int(scene_pos.x()),
-                int(scene_pos.y())
-            )
+        start_point = QPoint(int(scene_pos.x()), int(scene_pos.y()))
+
+        # Shift replaces every occurrence of the color within the selection,
+        # Ctrl+Shift across the whole sheet, rather than only the contiguous area
+        if event.modifiers() & Qt.ShiftModifier:
+            target_color = self.image.pixelIndex(start_point)
+            if event.modifiers() & Qt.ControlModifier:
+                self.color_replaced.emit(target_color, self.color_index, QRect())
+            else:
+                self.color_replaced.emit(target_color, self.color_index, selection_rect or self.image.rect())
+            return
+
+        self.stroke = StrokeBuffer(
+            self.image.width(),
+            self.image.height(),
+            selection_rect or self.image.rect()
         )
-        self.scene_edited.emit(self.image)
+        self.stroke.set_color(self.color, self.color_index)
+        self.flood_fill(start_point)
+
+        if self.stroke.edits_made():
+            self.scene_edited.emit(self.stroke.get_image(), self.stroke.get_origin())
 
     def flood_fill(self, start_point):
-        width = self.image.width()
-        height = self.image.height()
-        target_color = self.image.pixelIndex(start_point)
-        selection_rect = self.view.get_selection()
-        visited = set()
+        # Span based fill; the stroke buffer doubles as the visited mask,
+        # since filled pixels are the only ones not left transparent
+        bounds = self.stroke.clip_rect
+        if not bounds.contains(start_point):
+            return
 
-        def is_valid_point(point):
-            x, y = point.x(), point.y()
-            return (
-                0 <= x < width and
-                0 <= y < height and
-                self.image.pixelIndex(point) == target_color and
-                (selection_rect is None or selection_rect.contains(point))
-            )
+        source = PixelData.image_buffer(self.image, writable=False)
+        visited = PixelData.image_buffer(self.stroke.image, writable=False)
+        stride = self.image.bytesPerLine()
+        target_color = source[start_point.y() * stride + start_point.x()]
+        if target_color == self.color_index:
+            return
 
-        stack = [start_point]
+        target_byte = bytes([target_color])
+        target_runs = re.compile(re.escape(target_byte) + b"+")
+        stack = [(start_point.x(), start_point.y())]
 
         while stack:
-            point = stack.pop()
-
-            if (point.x(), point.y()) not in visited:
-                visited.add((point.x(), point.y()))
-                self.image.setPixel(point, self.color_index)
+            x, y = stack.pop()
+            row_offset = y * stride
+            if visited[row_offset + x] != StrokeBuffer.transparent_index:
+                continue
 
-                neighbors = [
-                    QPoint(point.x(), point.y() - 1),
-                    QPoint(point.x(), point.y() + 1),
-                    QPoint(point.x() - 1, point.y()),
-                    QPoint(point.x() + 1, point.y())
-                ]
+            # Extend the span left and right over the target color
+            row = source[row_offset + bounds.left():row_offset + bounds.right() + 1].tobytes()
+            head = row[:x - bounds.left() + 1]
+            tail = row[x - bounds.left():]
+            left = x - (len(head) - len(head.rstrip(target_byte))) + 1
+            right = x + (len(tail) - len(tail.lstrip(target_byte))) - 1
+            self.stroke.draw_span(y, left, right)
 
-                for neighbor in neighbors:
-                    if is_valid_point(neighbor):
-                        stack.append(neighbor)
+            # Seed one point per unvisited target run in the adjacent rows
+            for neighbor_y in (y - 1, y + 1):
+                if not bounds.top() <= neighbor_y <= bounds.bottom():
+                    continue
+                neighbor_offset = neighbor_y * stride
+                neighbor_row = source[neighbor_offset + left:neighbor_offset + right + 1].tobytes()
+                for run in target_runs.finditer(neighbor_row):
+                    run_x = left + run.start()
+                    if visited[neighbor_offset + run_x] == StrokeBuffer.transparent_index:
+                        stack.append((run_x, neighbor_y))
 
     def set_color(self, color, color_index):
         self.color = color
@@ -1,26 +1,18 @@
-from PyQt5.QtWidgets import QGraphicsPixmapItem
-from PyQt5.QtGui import (
-    QPixmap,
-    QImage,
-    qAlpha
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import (
+    pyqtSignal,
+    QPoint
 )
-from PyQt5.QtCore import pyqtSignal
-from PyQt5.QtGui import (
-    QPixmap,
-    QPainter,
-    QPen
-)
-from PyQt5.QtCore import Qt
 from tools.base_tool import BaseTool
+from tools.stroke_buffer import StrokeBuffer
 
 class LineTool(BaseTool):
 
-    scene_edited = pyqtSignal(QImage)
+    scene_edited = pyqtSignal(QImage, QPoint)
 
     def __init__(self, view):
         super().__init__(view)
-        self.pixmap = None
-        self.pixmap_item = None
+        self.stroke = None
         self.color = None
         self.color_index = None
         self.start_point = None
@@ -29,72 +21,40 @@ class LineTool(BaseTool):
     def mousePressEvent(self, event):
         scene_pos = self.view.mapToScene(event.pos())
         scene_rect = self.view.scene().sceneRect()
-        self.pixmap = QPixmap(
+        self.stroke = StrokeBuffer(
             int(scene_rect.width()),
-            int(scene_rect.height())
+            int(scene_rect.height()),
+            self.view.get_selection() or scene_rect.toRect()
         )
-        self.pixmap.fill(Qt.transparent)
-        self.start_point = scene_pos.toPoint()
-        self.end_point = scene_pos
+        self.stroke.set_color(self.color, self.color_index)
+        self.view.stroke_preview.set_stroke(self.stroke)
+        self.start_point = StrokeBuffer.to_pixel(scene_pos)
+        self.end_point = self.start_point
         self.mouseMoveEvent(event)
 
     def mouseMoveEvent(self, event):
         if self.start_point is None:
             return
 
-        self.end_point = self.view.mapToScene(event.pos())
-        painter = QPainter(self.pixmap)
-        pen = QPen(self.color)
-        painter.setPen(pen)
-        self.pixmap.fill(Qt.transparent)
-        painter.setClipRect(
-            self.view.get_selection() or self.view.scene().sceneRect()
-        )
-        painter.drawLine(self.start_point, self.end_point)
-
-        scene = self.view.scene()
-        if self.pixmap_item:
-            scene.removeItem(self.pixmap_item)
-        self.pixmap_item = QGraphicsPixmapItem(self.pixmap)
-        scene.addItem(self.pixmap_item)
+        self.end_point = StrokeBuffer.to_pixel(self.view.mapToScene(event.pos()))
+        self.stroke.clear()
+        self.stroke.draw_line(self.start_point, self.end_point)
+        self.view.stroke_preview.update_stroke()
 
     def mouseReleaseEvent(self, event):
         if self.start_point is None:
             return
 
-        scene = self.view.scene()
-        scene.removeItem(self.pixmap_item)
-        scene.setSceneRect(scene.itemsBoundingRect())
-        self.pixmap_item = None
+        self.view.stroke_preview.set_stroke(None)
         self.start_point = None
 
         if not self.edits_made():
             return
 
-        image = QImage(self.pixmap.size(), QImage.Format_Indexed8)
-        image.setColorCount(17)
-        image.setColor(self.color_index, self.color.rgb())
-
-        for y in range(self.pixmap.height()):
-            for x in range(self.pixmap.width()):
-                pixel = self.pixmap.toImage().pixel(x, y)
-                if pixel == self.color.rgb():
-                    image.setPixel(x, y, self.color_index)
-                else:
-                    image.setPixel(x, y, 16)
-
-        self.scene_edited.emit(image)
-
+        self.scene_edited.emit(self.stroke.get_image(), self.stroke.get_origin())
 
     def edits_made(self):
-        for y in range(self.pixmap.height()):
-            for x in range(self.pixmap.width()):
-                pixel = self.pixmap.toImage().pixel(x, y)
-                alpha = qAlpha(pixel)
-                if alpha != 0:
-                    return True
-
-        return False
+        return self.stroke.edits_made()
 
     def set_color(self, color, color_index):
         self.color = color
@@ -0,0 +1,128 @@
+import math
+from PyQt5.QtCore import (
+    QPoint,
+    QRect
+)
+from PyQt5.QtGui import QImage
+from pixel_data import PixelData
+
+def line_points(start, end):
+    # Bresenham's line, including both end points
+    x, y = start.x(), start.y()
+    x_end, y_end = end.x(), end.y()
+    dx = abs(x_end - x)
+    dy = -abs(y_end - y)
+    x_step = 1 if x < x_end else -1
+    y_step = 1 if y < y_end else -1
+    error = dx + dy
+
+    while True:
+        yield (x, y)
+        if x == x_end and y == y_end:
+            return
+        double_error = 2 * error
+        if double_error >= dy:
+            error += dy
+            x += x_step
+        if double_error <= dx:
+            error += dx
+            y += y_step
+
+def rectangle_spans(start, end):
+    left, right = sorted((start.x(), end.x()))
+    top, bottom = sorted((start.y(), end.y()))
+    for y in range(top, bottom + 1):
+        yield (y, left, right)
+
+def ellipse_spans(start, end):
+    # Filled ellipse inscribed in the inclusive pixel box between the two
+    # points, using doubled coordinates so pixel centres stay integers
+    left, right = sorted((start.x(), end.x()))
+    top, bottom = sorted((start.y(), end.y()))
+    width = right - left + 1
+    height = bottom - top + 1
+
+    for y in range(top, bottom + 1):
+        v = 2 * y - (top + bottom)
+        u_squared = width * width * (height * height - v * v) // (height * height)
+        u_max = int(math.sqrt(u_squared))
+        while u_max * u_max > u_squared:
+            u_max -= 1
+        if (u_max - (width - 1)) % 2:
+            u_max -= 1
+        if u_max >= 0:
+            yield (y, (left + right - u_max) // 2, (left + right + u_max) // 2)
+
+class StrokeBuffer:
+
+    transparent_index = 16
+
+    def __init__(self, width, height, clip_rect):
+        self.image = QImage(width, height, QImage.Format_Indexed8)
+        self.image.setColorCount(StrokeBuffer.transparent_index + 1)
+        self.image.setColor(StrokeBuffer.transparent_index, 0)
+        self.image.fill(StrokeBuffer.transparent_index)
+        self.clip_rect = clip_rect.intersected(self.image.rect())
+        self.dirty_rect = QRect()
+        self.changed_rect = QRect()
+        self.color_index = 0
+
+    @staticmethod
+    def to_pixel(scene_pos):
+        return QPoint(math.floor(scene_pos.x()), math.floor(scene_pos.y()))
+
+    def set_color(self, color, color_index):
+        self.color_index = color_index
+        self.image.setColor(color_index, color.rgba())
+
+    def clear(self):
+        # Only the rows touched since the last clear need resetting
+        buffer = PixelData.image_buffer(self.image)
+        stride = self.image.bytesPerLine()
+        blank_span = bytes([StrokeBuffer.transparent_index]) * self.dirty_rect.width()
+        for y in range(self.dirty_rect.top(), self.dirty_rect.bottom() + 1):
+            offset = y * stride + self.dirty_rect.left()
+            buffer[offset:offset + self.dirty_rect.width()] = blank_span
+
+        self.changed_rect = self.changed_rect.united(self.dirty_rect)
+        self.dirty_rect = QRect()
+
+    def draw_span(self, y, left, right):
+        left = max(left, self.clip_rect.left())
+        right = min(right, self.clip_rect.right())
+        if not self.clip_rect.top() <= y <= self.clip_rect.bottom() or left > right:
+            return
+
+        offset = y * self.image.bytesPerLine()
+        buffer = PixelData.image_buffer(self.image)
+        buffer[offset + left:offset + right + 1] = bytes([self.color_index]) * (right - left + 1)
+        span_rect = QRect(left, y, right - left + 1, 1)
+        self.dirty_rect = self.dirty_rect.united(span_rect)
+        self.changed_rect = self.changed_rect.united(span_rect)
+
+    def draw_line(self, start, end):
+        for x, y in line_points(start, end):
+            self.draw_span(y, x, x)
+
+    def draw_rectangle(self, start, end):
+        for span in rectangle_spans(start, end):
+            self.draw_span(*span)
+
+    def draw_ellipse(self, start, end):
+        for span in ellipse_spans(start, end):
+            self.draw_span(*span)
+
+    def take_changed_rect(self):
+        # Pixels drawn or cleared since the last call, for repainting previews
+        changed_rect = self.changed_rect
+        self.changed_rect = QRect()
+        return changed_rect
+
+    def edits_made(self):
+        return not self.dirty_rect.isEmpty()
+
+    def get_image(self):
+        return self.image.copy(self.dirty_rect)
+
+    def get_origin(self):
+        return self.dirty_rect.topLeft()
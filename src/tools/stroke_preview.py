@@ -0,0 +1,39 @@
+from PyQt5.QtCore import (
+    QRect,
+    QRectF
+)
+from PyQt5.QtWidgets import QGraphicsItem
+
+class StrokePreviewItem(QGraphicsItem):
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.stroke = None
+        self.setZValue(1)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        if self.stroke is None:
+            return QRectF()
+
+        return QRectF(self.stroke.image.rect())
+
+    def paint(self, painter, option, widget):
+        if self.stroke is None:
+            return
+
+        # Draw straight from the stroke's indexed image, limited to the exposed area
+        exposed_rect = option.exposedRect.toAlignedRect().intersected(self.stroke.image.rect())
+        if not exposed_rect.isEmpty():
+            painter.drawImage(exposed_rect, self.stroke.image, exposed_rect)
+
+    def set_stroke(self, stroke):
+        self.prepareGeometryChange()
+        self.stroke = stroke
+        if stroke is not None:
+            stroke.take_changed_rect()
+
+    def update_stroke(self):
+        changed_rect = self.stroke.take_changed_rect()
+        if not changed_rect.isEmpty():
+            self.update(QRectF(changed_rect))
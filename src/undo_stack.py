@@ -1,20 +1,121 @@
 from PyQt5.QtWidgets import QUndoStack
-from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import (
+    pyqtSignal,
+    pyqtSlot
+)
 from collections import namedtuple
+from enum import IntEnum
 
 Validator = namedtuple('Validator', ['is_valid', 'validation_error'])
 
+class CommandId(IntEnum):
+    SET_COLOR = 1
+    SET_PIXELS = 2
+    SET_ASSET_NAME = 3
+    RENAME_COLOR_PALETTE = 4
+    RENAME_TILE_MAP = 5
+
 class UndoStack(QUndoStack):
 
     error_thrown = pyqtSignal(str)
 
-    def __init__(self, parent=None):
+    default_byte_budget = 32 * 1024 * 1024
+
+    def __init__(self, parent=None, byte_budget=default_byte_budget):
         super().__init__(parent)
+        self.byte_budget = byte_budget
+        # Byte size of each command, kept in step with the stack so pushes
+        # don't have to resum it, along with how far up it's been compressed
+        # and dropped
+        self.command_sizes = []
+        self.byte_size = 0
+        self.compressed_count = 0
+        self.dropped_count = 0
+        self.pushing = False
+        self.indexChanged.connect(self.check_command_sizes)
 
     def push(self, command):
         is_valid, validation_error = command.validate()
         if is_valid:
-            super().push(command)
+            # Pushing deletes any undone commands, then either adds the new
+            # command or merges it into the top one
+            self.truncate_command_sizes(self.index())
+            self.pushing = True
+            try:
+                super().push(command)
+            finally:
+                self.pushing = False
+            self.update_top_size()
+            self.enforce_byte_budget()
         else:
             if validation_error:
                 self.error_thrown.emit(validation_error)
+
+    def set_byte_budget(self, byte_budget):
+        self.byte_budget = byte_budget
+        self.enforce_byte_budget()
+
+    @staticmethod
+    def command_byte_size(command):
+        return command.byte_size() if hasattr(command, "byte_size") else 0
+
+    def get_byte_size(self):
+        return self.byte_size
+
+    def set_command_size(self, index):
+        command_size = UndoStack.command_byte_size(self.command(index))
+        self.byte_size += command_size - self.command_sizes[index]
+        self.command_sizes[index] = command_size
+
+    def truncate_command_sizes(self, count):
+        self.byte_size -= sum(self.command_sizes[count:])
+        del self.command_sizes[count:]
+        self.compressed_count = min(self.compressed_count, count)
+        self.dropped_count = min(self.dropped_count, count)
+
+    def update_top_size(self):
+        count = self.count()
+        if count == len(self.command_sizes) + 1:
+            self.command_sizes.append(0)
+        elif count != len(self.command_sizes) or count == 0:
+            self.recount_command_sizes()
+            return
+
+        # A merged top command has a new, uncompressed delta
+        self.compressed_count = min(self.compressed_count, count - 1)
+        self.dropped_count = min(self.dropped_count, count - 1)
+        self.set_command_size(count - 1)
+
+    def recount_command_sizes(self):
+        self.command_sizes = [UndoStack.command_byte_size(self.command(index)) for index in range(self.count())]
+        self.byte_size = sum(self.command_sizes)
+        self.compressed_count = 0
+        self.dropped_count = 0
+
+    @pyqtSlot(int)
+    def check_command_sizes(self, index):
+        # Clearing the stack, or undoing an obsolete command, deletes
+        # commands outside of a push
+        if not self.pushing and self.count() != len(self.command_sizes):
+            self.recount_command_sizes()
+
+    def enforce_byte_budget(self):
+        # QUndoStack can't drop commands off the bottom of the stack, so the
+        # oldest commands are compressed in place, then once they all are,
+        # the oldest applied ones give up their undo data entirely
+        while self.byte_size > self.byte_budget and self.compressed_count < self.count():
+            command = self.command(self.compressed_count)
+            if hasattr(command, "compress"):
+                command.compress()
+                self.set_command_size(self.compressed_count)
+            self.compressed_count += 1
+
+        while self.byte_size > self.byte_budget and self.dropped_count < self.index():
+            command = self.command(self.dropped_count)
+            if hasattr(command, "drop"):
+                command.drop()
+                self.set_command_size(self.dropped_count)
+                # States from before a dropped command can't be returned to
+                if 0 <= self.cleanIndex() <= self.dropped_count:
+                    self.resetClean()
+            self.dropped_count += 1